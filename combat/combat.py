@@ -1,47 +1,89 @@
 import pandas as pd
 import patsy
 import sys
+import time
+import ctypes
+import tracemalloc
+import weakref
+from contextlib import contextmanager
 import numpy.linalg as la
 import numpy as np
 import scipy
+import scipy.linalg
 import scanpy.api as sc
 from scipy.sparse import issparse
+from multiprocessing import Pool
+from multiprocessing.sharedctypes import RawArray
 
 """This code is mostly copied from Brent Pedersens Github repo, see https://github.com/brentp/combat.py
 """
 
 
-def adjust_nums(numerical_covariates, drop_idxs):
-    # if we dropped some values, have to adjust those with a larger index.
-    if numerical_covariates is None: return drop_idxs
-    return [nc - sum(nc < di for di in drop_idxs) for nc in numerical_covariates]
-
-def design_mat(mod, numerical_covariates, batch_levels):
-    # require levels to make sure they are in the same order as we use in the
-    # rest of the script.
-    design = patsy.dmatrix("~ 0 + C(batch, levels=%s)" % str(batch_levels),
-                                                  mod, return_type="dataframe")
-
-    mod = mod.drop(["batch"], axis=1)
-    numerical_covariates = list(numerical_covariates)
-    sys.stderr.write("found %i batches\n" % design.shape[1])
-    other_cols = [c for i, c in enumerate(mod.columns)
-                  if not i in numerical_covariates]
-    factor_matrix = mod[other_cols]
-    design = pd.concat((design, factor_matrix), axis=1)
-    if numerical_covariates is not None:
-        sys.stderr.write("found %i numerical covariates...\n"
-                            % len(numerical_covariates))
-        for i, nC in enumerate(numerical_covariates):
-            cname = mod.columns[nC]
-            sys.stderr.write("\t{0}\n".format(cname))
-            design[cname] = mod[mod.columns[nC]]
-    sys.stderr.write("found %i categorical variables:" % len(other_cols))
-    sys.stderr.write("\t" + ", ".join(other_cols) + '\n')
-    return design
-
-
-def combat(adata, batch, model=None, numerical_covariates=None):
+class DesignFactor(object):
+    """Factorization of a ComBat design, computed once and reused.
+
+    Holds an upper triangular R with R'R equal to the column-equilibrated
+    ``design' design``. ``solve`` then gives the least-squares coefficients for
+    any block of genes from ``design' data`` with two triangular solves, so the
+    dense, gene-blocked, parallel and streaming paths all share one
+    factorization instead of inverting ``design' design``. These are the
+    semi-normal equations, whose error still grows with the square of the
+    condition number of the design. Where the design is in memory,
+    ``from_design(design, thin=True)`` also keeps the thin Q of the design and
+    ``solve_qr`` gives the coefficients from ``Q' data`` with a single
+    triangular solve, which is backward stable.
+
+    Parameters
+    ----------
+    XtX : np.ndarray
+        The (n_covariates, n_covariates) cross-product ``design' design``
+    """
+
+    def __init__(self, XtX, R=None):
+        XtX = np.asarray(XtX, dtype=np.float64)
+        diag = np.diag(XtX)
+        if (diag <= 0).any():
+            raise ValueError('The design matrix has {} all-zero columns.'.format(np.sum(diag <= 0)))
+        self.scale = 1 / np.sqrt(diag)
+        if R is None:
+            R = la.cholesky(XtX * np.outer(self.scale, self.scale)).T
+        self.R = R
+        self.Q = None
+        r = np.abs(np.diag(R))
+        if r.min() <= len(r) * np.finfo(np.float64).eps * r.max():
+            raise ValueError('The design matrix is singular, check for collinear covariates.')
+
+    @classmethod
+    def from_design(cls, design, thin=False):
+        """Factorize via a QR decomposition of the design itself rather than a
+        Cholesky decomposition of ``design' design``. With ``thin``, the
+        (n_cells, n_covariates) factor Q is kept as ``self.Q`` for
+        ``solve_qr``."""
+        design = np.asarray(design, dtype=np.float64)
+        XtX = np.dot(design.T, design)
+        scale = 1 / np.sqrt(np.maximum(np.diag(XtX), np.finfo(np.float64).tiny))
+        if thin:
+            Q, R = la.qr(design * scale)
+        else:
+            Q, R = None, la.qr(design * scale, mode='r')
+        factor = cls(XtX, R=R)
+        factor.Q = Q
+        return factor
+
+    def solve(self, XtY):
+        """Least-squares coefficients ``(design' design)^-1 XtY``."""
+        z = scipy.linalg.solve_triangular(self.R, self.scale[:, None] * XtY, trans='T')
+        return self.scale[:, None] * scipy.linalg.solve_triangular(self.R, z)
+
+    def solve_qr(self, QtY):
+        """Least-squares coefficients from ``Q' data``, see ``from_design``."""
+        return self.scale[:, None] * scipy.linalg.solve_triangular(self.R, QtY)
+
+
+def combat(adata, batch, model=None, numerical_covariates=None, block_size=None, n_jobs=1,
+           parametric=True, n_prior_genes=None, random_state=0, key=None, key_added=None,
+           dtype=None, inplace=False, ref_batch=None, mean_only=False, n_fit_cells=None,
+           max_iter=1000, out=None, report_memory=False):
     """Correct for batch effects in a dataset. Expexts normalised, filtered data which
     has not yet been variance stabilised or log transformed.
 
@@ -60,155 +102,1345 @@ def combat(adata, batch, model=None, numerical_covariates=None):
     numerical_covariates : list-like
         List of covariates in the model which are numerical, rather than
         categorical
+    block_size : int, optional
+        If given, the input ``adata.X`` is not densified. The linear model, the
+        pooled variance and the per-batch location/scale estimates are computed
+        from per-batch sufficient statistics (sparse products for CSR/CSC input)
+        and the corrected values are computed ``block_size`` genes at a time, so
+        the temporaries are bounded by ``n_cells * block_size``. The corrected
+        matrix itself is dense and ``n_cells * n_genes``: it is held in memory
+        unless ``out`` is given.
+    n_jobs : int, optional (default: 1)
+        Number of processes. Values above 1 shard the genes across a process
+        pool which reads the data from, and writes the result to, shared
+        memory. Implies ``block_size=1000`` if no block size is given.
+    parametric : bool, optional (default: True)
+        Use the parametric empirical-Bayes priors. If False, the
+        non-parametric variant of sva is used, which integrates every gene's
+        likelihood over the location/scale estimates of all other genes
+    n_prior_genes : int, optional
+        Non-parametric mode only. Integrate over a random subsample of this
+        many genes per batch instead of all genes
+    random_state : int, optional (default: 0)
+        Seed for the gene subsample of ``n_prior_genes``
+    key : str, optional
+        Correct the embedding ``adata.obsm[key]`` (e.g. ``'X_pca'``) instead of
+        ``adata.X``. The same location/scale model is applied to every
+        dimension, without the log transform, and ``adata.X`` is left untouched
+    key_added : str, optional
+        Key in ``adata.obsm`` for the corrected embedding, defaults to
+        ``key + '_combat'``
+    dtype : numpy dtype, optional
+        dtype of the corrected data. The dense path also works in this dtype,
+        e.g. ``np.float32`` halves its memory. Defaults to ``np.float64`` for
+        the dense path and to the float dtype of ``adata.X`` for the block path
+    inplace : bool, optional (default: False)
+        Dense path only. If ``adata.X`` is a dense array of ``dtype``, reuse it
+        as the working buffer instead of allocating a new one
+    ref_batch : optional
+        Adjust all batches towards this reference batch, which is left
+        unchanged. The reference mean and variance are estimated once and each
+        other batch from its own cells, see ``ComBatModel.fit_reference``,
+        which also allows to keep the reference for later batches. Always
+        corrects ``adata.X`` ``block_size`` genes at a time, so ``key``,
+        ``key_added``, ``inplace`` and ``n_fit_cells`` are not supported and
+        raise a ``ValueError``
+    mean_only : bool, optional (default: False)
+        Only adjust the batch means, as ``mean.only`` in sva. The scale is not
+        adjusted, so the per-batch variances are never computed, and the
+        location estimates are shrunk by the closed-form posterior mean
+        instead of the iterative solver. Useful if some batches are too small
+        for a stable scale estimate
+    n_fit_cells : int, optional
+        Fit the model, i.e. the linear model, the per-batch location/scale
+        estimates and their priors, on a random subsample of at most this many
+        cells per batch, drawn with seed ``random_state``. All cells are then
+        adjusted in one pass over the data, ``block_size`` genes at a time
+        (implies ``block_size=1000`` if not given). Not supported with
+        ``ref_batch``
+    max_iter : int, optional (default: 1000)
+        Maximum number of iterations of the parametric empirical-Bayes solver.
+        Genes which have not converged by then keep their last estimates and
+        are counted in ``adata.uns['combat']['n_unconverged']``
+    out : array-like, optional
+        Array of shape ``adata.shape`` which the corrected values are written
+        into, one gene block at a time, e.g. an ``np.memmap`` or an h5py
+        dataset, so the result never has to fit in memory (implies
+        ``block_size=1000`` if not given). If it is a numpy array (including
+        ``np.memmap``) it becomes ``adata.X``, otherwise ``adata.X`` is left
+        unchanged. Not supported with ``key``
+    report_memory : bool, optional (default: False)
+        Trace the peak memory allocated, so the requirements of larger jobs can
+        be extrapolated from a subsample. It is stored in
+        ``adata.uns['combat']['peak_bytes']`` and reported on stderr. This
+        counts the allocations of this process, including the shared buffers
+        handed to the workers, but not the allocations made inside the worker
+        processes when ``n_jobs > 1``. Tracing slows down the Python-level
+        loops, so it is off by default
 
     Returns
     -------
-    corrected : pandas.DataFrame
-        A (n_features, n_samples) dataframe of the batch-corrected data
+    Nothing, the batch-corrected data replaces ``adata.X`` as a dense array.
+    ``adata.uns['combat']`` holds the diagnostics of the fit: the
+    ``batch_levels``, the empirical-Bayes estimates ``gamma_star`` and
+    ``delta_star`` (batches x genes), the priors ``gamma_bar``, ``t2``,
+    ``a_prior`` and ``b_prior`` (parametric mode), the iterations ``n_iter``
+    and number of unconverged genes ``n_unconverged`` per batch, the
+    wall time in seconds of each phase in ``timings`` and, with
+    ``report_memory``, the peak memory allocated in ``peak_bytes``.
+    """
+
+    info = {}
+    if key is not None and out is not None:
+        raise ValueError('`out` cannot be used with `key`.')
+    if ref_batch is not None:
+        unsupported = [name for name, value in [('key', key), ('key_added', key_added),
+                                                ('inplace', inplace),
+                                                ('n_fit_cells', n_fit_cells)] if value]
+        if unsupported:
+            raise ValueError('`{}` cannot be used with `ref_batch`.'.format(
+                '`, `'.join(unsupported)))
+        combat_model = ComBatModel(block_size or 1000, n_jobs, parametric, n_prior_genes,
+                                   random_state, mean_only, max_iter)
+        memory = {}
+        with _peak_memory(memory, report_memory):
+            combat_model.fit_reference(adata, batch, ref_batch, model, numerical_covariates)
+            sys.stdout.write("Adjusting data\n")
+            combat_model.transform(adata, batch, model, out=out, dtype=dtype)
+        combat_model.info.update(memory)
+        _store_info(adata, combat_model.info)
+        return
+
+    with _timed(info, 'design'):
+        design, codes, batch_levels, _ = _combat_design(adata, batch, model,
+                                                        numerical_covariates)
+        n_batch = len(batch_levels)
+        covariates = design[:, n_batch:]
+    info['batch_levels'] = np.array([str(l) for l in batch_levels])
+    eb_kwargs = dict(parametric=parametric, n_prior_genes=n_prior_genes,
+                     random_state=random_state, mean_only=mean_only, max_iter=max_iter,
+                     info=info)
+
+    fit_cells = _subsample_cells(codes, n_fit_cells, random_state)
+    if (n_jobs > 1 or fit_cells is not None or out is not None) and block_size is None:
+        block_size = 1000
+
+    with _peak_memory(info, report_memory):
+        if key is not None:
+            X = np.asarray(adata.obsm[key], dtype=np.float64)
+            params = _fit_blocks(X, design, n_batch, X.shape[1], log=False, cells=fit_cells,
+                                 **eb_kwargs)
+            sys.stdout.write("Adjusting data\n")
+            if key_added is None:
+                key_added = key + '_combat'
+            with _timed(info, 'adjust'):
+                adata.obsm[key_added] = _adjust_blocks(X, params, codes, covariates,
+                                                       X.shape[1], log=False, dtype=dtype)
+        elif block_size is not None:
+            params = _fit_blocks(adata.X, design, n_batch, block_size, n_jobs, cells=fit_cells,
+                                 **eb_kwargs)
+            sys.stdout.write("Adjusting data\n")
+            with _timed(info, 'adjust'):
+                data_f = _adjust_blocks(adata.X, params, codes, covariates, block_size,
+                                        n_jobs, dtype=dtype, out=out)
+            if isinstance(data_f, np.ndarray):
+                adata.X = data_f
+        else:
+            adata.X = _combat_dense(adata.X, design, n_batch, dtype=dtype, inplace=inplace,
+                                    **eb_kwargs)
+    _store_info(adata, info)
+
+def _combat_dense(X, design, n_batch, dtype=None, inplace=False, chunk_size=10000,
+                  **eb_kwargs):
+    """ComBat on one dense (n_cells, n_genes) buffer.
+
+    The log transformed data is standardized, adjusted and back-transformed in
+    place in three passes over ``chunk_size`` cells at a time, so apart from
+    the buffer itself only chunk-sized temporaries are allocated. With
+    ``inplace`` and a dense X of the requested dtype, X itself is the buffer.
+
+    The chunks are taken batch by batch, so every chunk lies within one batch:
+    the per-batch sums are plain column sums and the adjustment is one scale
+    and shift per batch. A new buffer keeps the original row order and chunks
+    of cells which are not grouped by batch are gathered and scattered back.
+    X itself is sorted by batch in place instead, so that every chunk is a
+    view, and its rows are restored to their original order at the end.
+    Cells which are already grouped by batch are never moved. Returns the
+    corrected buffer.
+    """
+    dtype = np.dtype(np.float64 if dtype is None else dtype)
+    codes = design[:, :n_batch].argmax(axis=1)
+    n_cells = X.shape[0]
+    n_batches = np.bincount(codes, minlength=n_batch).astype(np.float64)
+
+    # batches in the order of their first cell, so grouped cells keep their place
+    first = np.full(n_batch, n_cells)
+    np.minimum.at(first, codes, np.arange(n_cells))
+    rank = np.empty(n_batch, dtype=int)
+    rank[np.argsort(first, kind='stable')] = np.arange(n_batch)
+    order = np.argsort(rank[codes], kind='stable')
+    design = design[order]
+    covariates = design[:, n_batch:]
+    bounds = np.zeros(n_batch + 1, dtype=int)
+    bounds[rank + 1] = n_batches
+    bounds = np.cumsum(bounds)
+    starts = bounds[rank]
+    chunks = [(b, slice(start, min(start + chunk_size, starts[b] + int(n_batches[b]))))
+              for b in np.argsort(rank)
+              for start in range(starts[b], starts[b] + int(n_batches[b]), chunk_size)]
+
+    grouped = np.array_equal(order, np.arange(n_cells))
+    sort_rows = (not grouped and inplace and not issparse(X) and X.dtype == dtype
+                 and X.flags.writeable)
+    # (batch, rows of the sorted design, rows of the buffer) of every chunk
+    chunks = [(b, cells, cells if grouped or sort_rows else order[cells])
+              for b, cells in chunks]
+
+    if inplace and not issparse(X) and X.dtype == dtype and X.flags.writeable:
+        data = X
+        if sort_rows:
+            _permute_rows(data, order)
+    else:
+        data = None
+    info = eb_kwargs.get('info')
+    with _timed(info, 'standardize'):
+        factor = DesignFactor.from_design(design, thin=True)
+        # log transform and Q' data in one pass
+        if data is None:
+            data = np.empty(X.shape, dtype=dtype)
+            for b, cells, rows in chunks:
+                data[rows] = X[rows].toarray() if issparse(X) else X[rows]
+        QtY = 0
+        for b, cells, rows in chunks:
+            chunk = data[rows]
+            np.log1p(chunk, out=chunk)
+            QtY = QtY + np.dot(factor.Q[cells].T, chunk.astype(np.float64, copy=False))
+            if not isinstance(rows, slice):
+                data[rows] = chunk
+
+        sys.stderr.write("Standardizing Data across genes.\n")
+        B_hat = factor.solve_qr(QtY)
+        del factor
+        grand_mean = np.dot(n_batches / n_cells, B_hat[:n_batch])
+        B_cov = B_hat[n_batch:]
+
+        # subtract stand_mean and collect the per-batch sums of what is left
+        sums = np.zeros((n_batch, X.shape[1]))
+        sumsq = np.zeros((n_batch, X.shape[1]))
+        for b, cells, rows in chunks:
+            chunk = data[rows]
+            chunk -= grand_mean.astype(dtype)
+            if covariates.shape[1]:
+                chunk -= np.dot(covariates[cells], B_cov).astype(dtype, copy=False)
+            chunk64 = chunk.astype(np.float64, copy=False)
+            sums[b] += chunk64.sum(axis=0)
+            sumsq[b] += np.einsum('ij,ij->j', chunk64, chunk64)
+            if not isinstance(rows, slice):
+                data[rows] = chunk
+
+        # the batch columns of B_hat are the batch offsets relative to grand_mean
+        offset = B_hat[:n_batch] - grand_mean
+        var_pooled = (sumsq.sum(axis=0) - 2 * (offset * sums).sum(axis=0)
+                      + np.dot(n_batches, offset**2)) / n_cells
+        var_pooled[var_pooled <= 1e-12 * sumsq.sum(axis=0) / n_cells] = 0
+
+        print('Found {} genes with zero variance. Will be zero after tranformation.'.\
+          format(np.sum(var_pooled == 0)))
+
+        sys.stderr.write("Fitting L/S model and finding priors\n")
+        # need to be a bit careful with the zero variance genes
+        with np.errstate(divide='ignore'):
+            inv_sd = np.where(var_pooled == 0, 0, 1 / np.sqrt(var_pooled))
+        s_sums = sums * inv_sd
+        gamma_hat = s_sums / n_batches[:, None]
+        if eb_kwargs.get('mean_only'):
+            s_sumsq, delta_hat = None, None
+        else:
+            s_sumsq = sumsq * inv_sd**2
+            delta_hat = np.maximum((s_sumsq - n_batches[:, None] * gamma_hat**2)
+                                   / (n_batches[:, None] - 1), 0)
+    gamma_star, delta_star = _empirical_bayes(s_sums, s_sumsq, n_batches, gamma_hat,
+                                              delta_hat, **eb_kwargs)
+
+    sys.stdout.write("Adjusting data\n")
+    # ((data / sd - gamma_star) / sqrt(delta_star)) * sd + stand_mean as one
+    # scale and shift per batch
+    vpsq = np.sqrt(var_pooled)
+    scale = (inv_sd * vpsq) / np.sqrt(delta_star)
+    shift = grand_mean - gamma_star * vpsq / np.sqrt(delta_star)
+    with _timed(info, 'adjust'):
+        for b, cells, rows in chunks:
+            chunk = data[rows]
+            chunk *= scale[b].astype(dtype)
+            chunk += shift[b].astype(dtype)
+            if covariates.shape[1]:
+                chunk += np.dot(covariates[cells], B_cov).astype(dtype, copy=False)
+            np.expm1(chunk, out=chunk)
+            if not isinstance(rows, slice):
+                data[rows] = chunk
+        if sort_rows:
+            _permute_rows(data, np.argsort(order))
+    return data
+
+def _permute_rows(data, order):
+    """Reorder the rows of ``data`` in place, so that row i becomes the former
+    row ``order[i]``. Only rows which move are touched, one at a time."""
+    moved = order != np.arange(len(order))
+    done = ~moved
+    for start in np.flatnonzero(moved):
+        if done[start]:
+            continue
+        row = data[start].copy()
+        i = start
+        while order[i] != start:
+            data[i] = data[order[i]]
+            done[i] = True
+            i = order[i]
+        data[i] = row
+        done[i] = True
+
+@contextmanager
+def _peak_memory(info, enabled=True):
+    """Store the peak memory allocated while the block runs in
+    ``info['peak_bytes']``, if ``enabled``.
+
+    This is the peak traced by ``tracemalloc`` (which includes numpy buffers)
+    plus the peak size of the shared-memory buffers from ``_shared_empty``,
+    which ``tracemalloc`` does not see. Memory allocated inside worker
+    processes is not included.
+    """
+    if not enabled:
+        yield
+        return
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    _shared_bytes['peak'] = _shared_bytes['current']
+    try:
+        yield
+    finally:
+        info['peak_bytes'] = tracemalloc.get_traced_memory()[1] + _shared_bytes['peak']
+        if not tracing:
+            tracemalloc.stop()
+
+def _combat_design(adata, batch, model=None, numerical_covariates=None, batch_levels=None):
+    """Build the design matrix used by ``combat``.
+
+    Returns the design as a float array (batch indicators first, then the
+    categorical and then the numerical covariates), the integer
+    batch code of every cell, the batch levels in the order of the design
+    columns and the names of the covariate columns. If ``batch_levels`` is
+    given, the design has one column per level even if some batches have no
+    cells. ``model`` is not modified.
     """
-    
-    # transform adata to data frame of the right shape and 
-    if issparse(adata.X): 
-        X = adata.X.A 
-    else: 
-        X = adata.X
-    data_a = X.T
-    data_a = np.log(data_a + 1)
-    data = pd.DataFrame(data = data_a, index = adata.var_names,
-                        columns= adata.obs_names)
-    
     if isinstance(batch, str):
-        batch = pd.Series(adata.obs[batch])
+        batch = adata.obs[batch]
+    batch = np.asarray(batch)
 
     if isinstance(numerical_covariates, str):
         numerical_covariates = [numerical_covariates]
     if numerical_covariates is None:
         numerical_covariates = []
 
-    if model is not None and isinstance(model, pd.DataFrame):
-        model["batch"] = list(batch)
+    labels, codes = np.unique(batch, return_inverse=True)
+    if batch_levels is None:
+        batch_levels = list(labels)
     else:
-        model = pd.DataFrame({'batch': batch})
+        index = {level: i for i, level in enumerate(batch_levels)}
+        unknown = [l for l in labels if l not in index]
+        if len(unknown) > 0:
+            raise ValueError('Batches {} are not in `batch_levels`.'.format(unknown))
+        codes = np.array([index[l] for l in labels], dtype=int)[codes]
+    n_batch = len(batch_levels)
+    sys.stderr.write("found %i batches\n" % n_batch)
 
-    batch_items = model.groupby("batch").groups.items()
-    batch_levels = [k for k, v in batch_items]
-    batch_info = [v for k, v in batch_items]
-    n_batch = len(batch_info)
-    n_batches = np.array([len(v) for v in batch_info])
-    n_array = float(sum(n_batches))
+    if model is None:
+        columns, values = [], np.zeros((len(batch), 0))
+    else:
+        columns = [c for c in model.columns if c != 'batch']
+        values = np.asarray(model[columns], dtype=np.float64)
+        # drop intercept
+        keep = ~(values == 1).all(axis=0)
+        columns, values = [c for c, k in zip(columns, keep) if k], values[:, keep]
+    # numerical covariates are given by name or by position after the intercept was dropped
+    numerical = [c if isinstance(c, str) else columns[c] for c in numerical_covariates]
+    numerical = [c for c in numerical if c in columns]
+    other = [c for c in columns if c not in numerical]
+    if len(numerical) > 0:
+        sys.stderr.write("found %i numerical covariates...\n" % len(numerical))
+        for c in numerical:
+            sys.stderr.write("\t{0}\n".format(c))
+    sys.stderr.write("found %i categorical variables:" % len(other))
+    sys.stderr.write("\t" + ", ".join(str(c) for c in other) + '\n')
+
+    covariate_names = other + numerical
+    design = np.zeros((len(batch), n_batch + len(covariate_names)))
+    design[np.arange(len(batch)), codes] = 1
+    design[:, n_batch:] = values[:, [columns.index(c) for c in covariate_names]]
+    return design, codes, batch_levels, covariate_names
+
+def _gene_blocks(X, block_size, log=True):
+    """Yield ``(slice, block)`` pairs where ``block`` is the dense, log
+    transformed (n_cells, block_size) slice of X."""
+    if issparse(X):
+        X = X.tocsc()
+    for genes in _blocks(X.shape[1], block_size):
+        yield genes, _log_block(X[:, genes], log)
+
+def _log_block(block, log=True):
+    """Dense float64 log(block + 1), or just the dense float64 block if not ``log``."""
+    block = block.toarray() if issparse(block) else np.array(block)
+    block = block.astype(np.float64, copy=False)
+    return np.log1p(block) if log else block
+
+def _batch_moments(X, codes, covariates, n_batch, block_size, log=True, Q=None):
+    """Per-batch sufficient statistics of log(X + 1), or of X if not ``log``.
+
+    Returns a dict with the number of cells per batch ``n`` and, per batch, the
+    sums ``sums`` and sums of squares ``sumsq`` of every gene, the covariate
+    sums ``cov_sums``, the covariate cross-products ``cov_cross`` and the
+    covariate/data cross-products ``cov_data``. If the thin Q of the design is
+    given (see ``DesignFactor.from_design``), ``Q' data`` is added as ``qtx``.
+    For sparse X these are computed with sparse products and X is never
+    densified.
+    """
+    n_cells = X.shape[0]
+    n_covs = covariates.shape[1]
+    cells = np.arange(n_cells)
+    indicator = scipy.sparse.csr_matrix((np.ones(n_cells), (cells, codes)),
+                                        shape=(n_cells, n_batch))
+    # covariates spread out into one set of columns per batch
+    expanded = scipy.sparse.csr_matrix(
+        (covariates.ravel(), (np.repeat(cells, n_covs),
+                              (codes[:, None] * n_covs + np.arange(n_covs)).ravel())),
+        shape=(n_cells, n_batch * n_covs))
+
+    moments = {'n': np.bincount(codes, minlength=n_batch).astype(np.float64),
+               'cov_sums': indicator.T.dot(covariates),
+               'cov_cross': expanded.T.dot(covariates).reshape(n_batch, n_covs, n_covs)}
+
+    n_genes = X.shape[1]
+    if issparse(X):
+        Y = scipy.sparse.csr_matrix(X, dtype=np.float64)
+        if log:
+            Y = Y.log1p()
+        moments['sums'] = indicator.T.dot(Y).toarray()
+        moments['sumsq'] = indicator.T.dot(Y.multiply(Y)).toarray()
+        moments['cov_data'] = expanded.T.dot(Y).toarray().reshape(n_batch, n_covs, n_genes)
+        if Q is not None:
+            moments['qtx'] = np.asarray(Y.T.dot(Q)).T
+        return moments
+
+    moments['sums'] = np.empty((n_batch, n_genes))
+    moments['sumsq'] = np.empty((n_batch, n_genes))
+    moments['cov_data'] = np.empty((n_batch, n_covs, n_genes))
+    if Q is not None:
+        moments['qtx'] = np.empty((Q.shape[1], n_genes))
+    for genes, Y in _gene_blocks(X, block_size, log):
+        moments['sums'][:, genes] = indicator.T.dot(Y)
+        moments['sumsq'][:, genes] = indicator.T.dot(Y**2)
+        moments['cov_data'][:, :, genes] = expanded.T.dot(Y).reshape(n_batch, n_covs, genes.stop - genes.start)
+        if Q is not None:
+            moments['qtx'][:, genes] = np.dot(Q.T, Y)
+    return moments
+
+def _fit_moments(moments, factor=None, mean_only=False):
+    """Fit the linear model and the per-batch location/scale estimates of the
+    standardized data from the statistics returned by ``_batch_moments``.
+    ``factor`` is a ``DesignFactor`` of the design, computed from the
+    statistics if not given. The coefficients are solved from ``qtx`` if the
+    statistics include it. See ``_standardize_moments`` for ``mean_only``."""
+    n = moments['n']
+    sums, sumsq = moments['sums'], moments['sumsq']
+    cov_sums, cov_cross, cov_data = moments['cov_sums'], moments['cov_cross'], moments['cov_data']
+    n_batch, n_array = len(n), n.sum()
+
+    # design cross-products, batch indicators first
+    XtX = np.block([[np.diag(n), cov_sums], [cov_sums.T, cov_cross.sum(axis=0)]])
+    XtY = np.vstack([sums, cov_data.sum(axis=0)])
+    if factor is None:
+        factor = DesignFactor(XtX)
+    if 'qtx' in moments:
+        B_hat = factor.solve_qr(moments['qtx'])
+    else:
+        B_hat = factor.solve(XtY)
+    grand_mean = np.dot(n / n_array, B_hat[:n_batch])
+    B_cov = B_hat[n_batch:]
+
+    var_pooled = (sumsq.sum(axis=0) - 2 * (B_hat * XtY).sum(axis=0)
+                  + (B_hat * np.dot(XtX, B_hat)).sum(axis=0)) / n_array
+    # cancellation leaves tiny non-zero values for constant genes
+    var_pooled[var_pooled <= 1e-12 * sumsq.sum(axis=0) / n_array] = 0
+
+    fit = {'B_hat': B_hat, 'grand_mean': grand_mean, 'var_pooled': var_pooled}
+    fit.update(_standardize_moments(moments, grand_mean, B_cov, var_pooled, mean_only))
+    return fit
+
+def _standardize_moments(moments, grand_mean, B_cov, var_pooled, mean_only=False):
+    """Per-batch sums ``s_sums`` and sums of squares ``s_sumsq`` of the
+    standardized data and the location/scale estimates ``gamma_hat`` and
+    ``delta_hat``, from the statistics returned by ``_batch_moments``. With
+    ``mean_only`` the second moments are skipped and ``s_sumsq`` and
+    ``delta_hat`` are None."""
+    n = moments['n']
+    sums, sumsq = moments['sums'], moments['sumsq']
+    cov_sums, cov_cross, cov_data = moments['cov_sums'], moments['cov_cross'], moments['cov_data']
+
+    # per batch statistics of data - stand_mean, where stand_mean = W' [1, covariates]
+    resid_sums = sums - np.outer(n, grand_mean) - np.dot(cov_sums, B_cov)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        s_sums = np.where(var_pooled == 0, 0, resid_sums / np.sqrt(var_pooled))
+    gamma_hat = s_sums / n[:, None]
+    if mean_only:
+        return {'s_sums': s_sums, 's_sumsq': None, 'gamma_hat': gamma_hat, 'delta_hat': None}
+
+    W = np.vstack([grand_mean, B_cov])
+    AtY = np.concatenate([sums[:, None, :], cov_data], axis=1)
+    AtA = np.concatenate([np.concatenate([n[:, None, None], cov_sums[:, None, :]], axis=2),
+                          np.concatenate([cov_sums[:, :, None], cov_cross], axis=2)], axis=1)
+    resid_sumsq = (sumsq - 2 * np.einsum('kg,bkg->bg', W, AtY)
+                   + np.einsum('kg,bkl,lg->bg', W, AtA, W))
+
+    # need to be a bit careful with the zero variance genes
+    with np.errstate(divide='ignore', invalid='ignore'):
+        s_sumsq = np.where(var_pooled == 0, 0, resid_sumsq / var_pooled)
+    delta_hat = (s_sumsq - n[:, None] * gamma_hat**2) / (n[:, None] - 1)
 
-    # drop intercept
-    drop_cols = [cname for cname, inter in  ((model == 1).all()).iteritems() if inter == True]
-    drop_idxs = [list(model.columns).index(cdrop) for cdrop in drop_cols]
-    model = model[[c for c in model.columns if not c in drop_cols]]
-    numerical_covariates = [list(model.columns).index(c) if isinstance(c, str) else c
-            for c in numerical_covariates if not c in drop_cols]
+    return {'s_sums': s_sums, 's_sumsq': s_sumsq,
+            'gamma_hat': gamma_hat, 'delta_hat': np.maximum(delta_hat, 0)}
 
-    design = design_mat(model, numerical_covariates, batch_levels)
+def _fit_blocks(X, design, n_batch, block_size, n_jobs=1, log=True, cells=None,
+                **eb_kwargs):
+    """Estimate the ComBat parameters from per-batch sufficient statistics.
+
+    Returns a dict with the per-gene ``grand_mean`` and ``var_pooled``, the
+    covariate coefficients ``B_cov`` and the per-batch ``gamma_star`` and
+    ``delta_star``. The model is fitted to log(X + 1), or to X if not ``log``,
+    using only the rows ``cells`` if given. ``eb_kwargs`` are passed on to
+    ``_empirical_bayes``.
+    """
+    if cells is not None:
+        X, design = X[cells], design[cells]
+    codes = design[:, :n_batch].argmax(axis=1)
+    covariates = design[:, n_batch:]
 
     sys.stderr.write("Standardizing Data across genes.\n")
-    B_hat = np.dot(np.dot(la.inv(np.dot(design.T, design)), design.T), data.T)
-    grand_mean = np.dot((n_batches / n_array).T, B_hat[:n_batch,:])
-    var_pooled = np.dot(((data - np.dot(design, B_hat).T)**2), np.ones((int(n_array), 1)) / int(n_array))
+    with _timed(eb_kwargs.get('info'), 'standardize'):
+        factor = DesignFactor.from_design(design, thin=True)
+        if n_jobs > 1:
+            blocks = _blocks(X.shape[1], block_size)
+            with _gene_pool(X, codes, covariates, n_jobs, Q=factor.Q) as pool:
+                shards = pool.starmap(_moments_worker, [(genes, n_batch, block_size, log)
+                                                        for genes in blocks])
+            moments = dict(shards[0])
+            for key, axis in [('sums', 1), ('sumsq', 1), ('cov_data', 2), ('qtx', 1)]:
+                moments[key] = np.concatenate([shard[key] for shard in shards], axis=axis)
+        else:
+            moments = _batch_moments(X, codes, covariates, n_batch, block_size, log, factor.Q)
+        factor.Q = None
+    return _params_from_moments(moments, n_jobs, factor, block_size=block_size, **eb_kwargs)
+
+def _params_from_moments(moments, n_jobs=1, factor=None, **eb_kwargs):
+    """Second half of ``_fit_blocks``: priors and empirical-Bayes estimates
+    from the per-batch sufficient statistics."""
+    n_batch = len(moments['n'])
+    with _timed(eb_kwargs.get('info'), 'standardize'):
+        fit = _fit_moments(moments, factor, eb_kwargs.get('mean_only', False))
+    var_pooled = fit['var_pooled']
 
     print('Found {} genes with zero variance. Will be zero after tranformation.'.\
       format(np.sum(var_pooled == 0)))
-    
-    stand_mean = np.dot(grand_mean.T.reshape((len(grand_mean), 1)), np.ones((1, int(n_array))))
-    tmp = np.array(design.copy())
-    tmp[:,:n_batch] = 0
-    stand_mean  += np.dot(tmp, B_hat).T
-
-    # need to be a bit careful with the zero variance genes
-    s_data = np.where(var_pooled == 0, 0, \
-        ((data - stand_mean) / np.dot(np.sqrt(var_pooled), np.ones((1, int(n_array))))))
-    s_data = pd.DataFrame(s_data, index=data.index, columns=data.columns)
 
     sys.stderr.write("Fitting L/S model and finding priors\n")
-    batch_design = design[design.columns[:n_batch]]
-    gamma_hat = np.dot(np.dot(la.inv(np.dot(batch_design.T, batch_design)), batch_design.T), s_data.T)
+    gamma_star, delta_star = _empirical_bayes(fit['s_sums'], fit['s_sumsq'], moments['n'],
+                                              fit['gamma_hat'], fit['delta_hat'],
+                                              n_jobs=n_jobs, **eb_kwargs)
 
-    delta_hat = []
+    return {'grand_mean': fit['grand_mean'], 'B_cov': fit['B_hat'][n_batch:],
+            'var_pooled': var_pooled, 'gamma_star': gamma_star, 'delta_star': delta_star}
 
-    for i, batch_idxs in enumerate(batch_info):
-        #batches = [list(model.columns).index(b) for b in batches]
-        delta_hat.append(s_data[batch_idxs].var(axis=1))
+def _adjust_blocks(X, params, codes, covariates, block_size, n_jobs=1, log=True, dtype=None,
+                   out=None):
+    """Apply fitted ComBat parameters to X, ``block_size`` genes at a time.
 
-    gamma_bar = gamma_hat.mean(axis=1) 
-    t2 = gamma_hat.var(axis=1)
-   
+    ``codes`` gives the batch of every cell as an index into the rows of
+    ``gamma_star``/``delta_star``. Returns the dense corrected matrix, back
+    transformed from the log scale if ``log``, of ``dtype`` or, by default, of
+    the float dtype of X. If ``out`` is given (anything that supports
+    ``out[:, genes] = block``, e.g. an ``np.memmap`` or an h5py dataset), every
+    block is written into it as soon as it is computed and ``out`` is
+    returned, so only one block is held in memory (per worker).
+    """
+    if dtype is None:
+        dtype = X.dtype if np.issubdtype(X.dtype, np.floating) else np.float64
+    if out is not None:
+        if tuple(out.shape) != tuple(X.shape):
+            raise ValueError('`out` has shape {}, expected {}.'.format(tuple(out.shape),
+                                                                      tuple(X.shape)))
+        tasks = [(genes, _param_slice(params, genes), log)
+                 for genes in _blocks(X.shape[1], block_size)]
+        if n_jobs > 1:
+            with _gene_pool(X, codes, covariates, n_jobs) as pool:
+                for (genes, _, _), block in zip(tasks, pool.imap(_adjust_worker_block, tasks)):
+                    out[:, genes] = block.astype(dtype, copy=False)
+        else:
+            for genes, data in _gene_blocks(X, block_size, log):
+                out[:, genes] = _adjust_block(data, _param_slice(params, genes), codes,
+                                              covariates, log).astype(dtype, copy=False)
+        return out
+    if n_jobs > 1:
+        out, data_f = _shared_empty(X.shape, dtype)
+        with _gene_pool(X, codes, covariates, n_jobs, out=out) as pool:
+            pool.starmap(_adjust_worker, [(genes, _param_slice(params, genes), log)
+                                          for genes in _blocks(X.shape[1], block_size)])
+        return data_f
 
-    a_prior = list(map(aprior, delta_hat))
-    b_prior = list(map(bprior, delta_hat))
+    data_f = np.empty(X.shape, dtype=dtype)
+    for genes, data in _gene_blocks(X, block_size, log):
+        data_f[:, genes] = _adjust_block(data, _param_slice(params, genes), codes, covariates,
+                                         log)
+    return data_f
 
-    sys.stderr.write("Finding parametric adjustments\n")
-    gamma_star, delta_star = [], []
-    for i, batch_idxs in enumerate(batch_info):
-        #print '18 20 22 28 29 31 32 33 35 40 46'
-        #print batch_info[batch_id]
+def _adjust_block(data, params, codes, covariates, log=True):
+    """Corrected values of one gene block, back-transformed if ``log``."""
+    stand_mean = params['grand_mean'] + np.dot(covariates, params['B_cov'])
+    vpsq = np.sqrt(params['var_pooled'])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        s_data = np.where(vpsq == 0, 0, (data - stand_mean) / vpsq)
+    bayesdata = (s_data - params['gamma_star'][codes]) / np.sqrt(params['delta_star'][codes])
+    bayesdata = bayesdata * vpsq + stand_mean
+    return np.expm1(bayesdata) if log else bayesdata
+
+def _param_slice(params, genes):
+    return {'grand_mean': params['grand_mean'][genes], 'B_cov': params['B_cov'][:, genes],
+            'var_pooled': params['var_pooled'][genes],
+            'gamma_star': params['gamma_star'][:, genes],
+            'delta_star': params['delta_star'][:, genes]}
+
+def _subsample_cells(codes, n_per_batch, random_state=0):
+    """Sorted indices of a random subsample of at most ``n_per_batch`` cells of
+    every batch, or None if ``n_per_batch`` is None."""
+    if n_per_batch is None:
+        return None
+    rng = np.random.RandomState(random_state)
+    cells = [rng.choice(batch_cells, min(n_per_batch, len(batch_cells)), replace=False)
+             for batch_cells in np.split(np.argsort(codes, kind='stable'),
+                                         np.cumsum(np.bincount(codes))[:-1])]
+    return np.sort(np.concatenate(cells))
+
+def _blocks(n_genes, block_size):
+    return [slice(start, min(start + block_size, n_genes))
+            for start in range(0, n_genes, block_size)]
+
+# Shared-memory views of the data in the worker processes of ``_gene_pool``
+_shared = {}
+
+def _shared_empty(shape, dtype):
+    """Allocate a shared-memory array. Returns the handle to pass to the
+    workers and a numpy view of it, which keeps the memory alive."""
+    dtype = np.dtype(dtype)
+    size = int(np.prod(shape))
+    nbytes = max(size * dtype.itemsize, 1)
+    raw = RawArray(ctypes.c_char, nbytes)
+    _shared_bytes['current'] += nbytes
+    _shared_bytes['peak'] = max(_shared_bytes['peak'], _shared_bytes['current'])
+    weakref.finalize(raw, _release_shared, nbytes)
+    handle = (raw, dtype.str, tuple(shape))
+    return handle, _shared_view(handle)
+
+def _release_shared(nbytes):
+    _shared_bytes['current'] -= nbytes
+
+# bytes of shared memory currently allocated in this process, and their peak
+_shared_bytes = {'current': 0, 'peak': 0}
+
+def _shared_view(handle):
+    raw, dtype, shape = handle
+    return np.frombuffer(raw, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+def _gene_pool(X, codes, covariates, n_jobs, out=None, Q=None):
+    """Process pool whose workers see X (as CSC if sparse), the batch codes, the
+    covariates and optionally an output array and the thin Q of the design
+    through shared memory, so only gene slices and per-gene parameters are
+    pickled."""
+    if issparse(X):
+        X = X.tocsc()
+        arrays = {'data': X.data, 'indices': X.indices, 'indptr': X.indptr,
+                  'shape': np.array(X.shape)}
+    else:
+        arrays = {'X': X}
+    arrays.update(codes=codes, covariates=covariates)
+    if Q is not None:
+        arrays['Q'] = Q
+
+    handles = {} if out is None else {'out': out}
+    for key, value in arrays.items():
+        value = np.asarray(value)
+        handles[key], view = _shared_empty(value.shape, value.dtype)
+        view[...] = value
+    return Pool(n_jobs, initializer=_init_worker, initargs=(handles,))
 
-        temp = it_sol(s_data[batch_idxs], gamma_hat[i],
-                     delta_hat[i], gamma_bar[i], t2[i], a_prior[i], b_prior[i])
+def _init_worker(handles):
+    global _shared
+    _shared = {key: _shared_view(handle) for key, handle in handles.items()}
 
-        gamma_star.append(temp[0])
-        delta_star.append(temp[1])
+def _shared_genes(genes):
+    if 'indptr' in _shared:
+        X = scipy.sparse.csc_matrix((_shared['data'], _shared['indices'], _shared['indptr']),
+                                    shape=tuple(_shared['shape']))
+        return X[:, genes]
+    return _shared['X'][:, genes]
+
+def _moments_worker(genes, n_batch, block_size, log):
+    return _batch_moments(_shared_genes(genes), _shared['codes'], _shared['covariates'],
+                          n_batch, block_size, log, _shared.get('Q'))
+
+def _adjust_worker(genes, params, log):
+    _shared['out'][:, genes] = _adjust_worker_block((genes, params, log))
+
+def _adjust_worker_block(task):
+    genes, params, log = task
+    return _adjust_block(_log_block(_shared_genes(genes), log), params,
+                         _shared['codes'], _shared['covariates'], log)
+
+def _add_moments(a, b):
+    return {key: a[key] + b[key] for key in _moment_keys}
+
+_moment_keys = ['n', 'sums', 'sumsq', 'cov_sums', 'cov_cross', 'cov_data']
+
+def combat_stats(adata, batch, batch_levels, model=None, numerical_covariates=None,
+                 block_size=1000):
+    """ComBat sufficient statistics of one shard of cells.
+
+    The statistics of disjoint shards can be combined with
+    ``merge_combat_stats`` in any order, and ``ComBatModel.fit_stats`` derives
+    the priors and ``gamma_star``/``delta_star`` from the merged statistics, so
+    the cells never need to be on one machine. All shards must use the same
+    ``batch_levels``, covariate columns and genes. The result is a dict of
+    arrays, so ``np.savez(filename, **stats)`` and ``dict(np.load(filename))``
+    can be used to move it between workers.
+
+    Parameters
+    ----------
+    adata : AnnData
+        One shard of normalised, filtered, not yet log transformed data
+    batch : str or pandas.Series
+        Key in ``adata.obs`` or the batch of every cell
+    batch_levels : list
+        All batches across all shards, in a fixed order
+    model, numerical_covariates
+        See ``combat``
+    block_size : int, optional (default: 1000)
+        Number of genes processed at a time for dense data
+
+    Returns
+    -------
+    stats : dict
+        Per-batch cell counts ``n``, sums ``sums`` and sums of squares ``sumsq``
+        of every gene, the covariate sums ``cov_sums``, covariate
+        cross-products ``cov_cross`` and covariate/data cross-products
+        ``cov_data``, plus ``batch_levels``, ``covariates`` and ``var_names``
+    """
+    design, codes, _, covariates = _combat_design(adata, batch, model, numerical_covariates,
+                                                  batch_levels=list(batch_levels))
+    n_batch = len(batch_levels)
+    stats = _batch_moments(adata.X, codes, design[:, n_batch:], n_batch, block_size)
+    stats.update(batch_levels=np.array([str(l) for l in batch_levels]),
+                 covariates=np.array([str(c) for c in covariates]),
+                 var_names=np.array(adata.var_names, dtype=str))
+    return stats
+
+def merge_combat_stats(*stats):
+    """Combine the ``combat_stats`` of disjoint shards of cells.
+
+    The reduction is associative and commutative, so shards can be merged
+    pairwise, in a tree or all at once.
+    """
+    merged = dict(stats[0])
+    for other in stats[1:]:
+        for key in ['batch_levels', 'covariates', 'var_names']:
+            if not np.array_equal(merged[key], other[key]):
+                raise ValueError('Cannot merge statistics with different `{}`.'.format(key))
+        merged.update(_add_moments(merged, other))
+    return merged
+
+def combat_backed(adata, batch, model=None, numerical_covariates=None, layer='combat',
+                  chunk_size=10000, block_size=1000, parametric=True, n_prior_genes=None,
+                  random_state=0, mean_only=False, n_fit_cells=None, max_iter=1000):
+    """Out-of-core ComBat for an AnnData opened with ``backed='r+'``.
+
+    The data is streamed twice in chunks of ``chunk_size`` cells. The first pass
+    accumulates the per-batch sufficient statistics (design cross-products,
+    sums and sums of squares), the second pass writes the corrected values to
+    the on-disk layer ``layers/<layer>`` of the backing file. ``adata.X`` is
+    left untouched and at most ``chunk_size`` cells are held in memory.
+
+    Parameters
+    ----------
+    adata : AnnData
+        Backed AnnData, opened in ``r+`` mode
+    batch, model, numerical_covariates
+        See ``combat``
+    layer : str, optional (default: ``'combat'``)
+        Name of the layer the corrected data is written to. An existing layer
+        of that name is replaced
+    chunk_size : int, optional (default: 10000)
+        Number of cells read per chunk
+    block_size : int, optional (default: 1000)
+        Number of genes processed at a time within a chunk
+    parametric, n_prior_genes, random_state, mean_only, max_iter
+        See ``combat``
+    n_fit_cells : int, optional
+        Fit the model on a random subsample of at most this many cells per
+        batch, see ``combat``. Only the subsample is read in the first pass
+
+    The diagnostics of the fit are stored in ``adata.uns['combat']``, see
+    ``combat``.
+    """
+    info = {}
+    with _timed(info, 'design'):
+        design, codes, batch_levels, _ = _combat_design(adata, batch, model,
+                                                        numerical_covariates)
+        n_batch = len(batch_levels)
+        covariates = design[:, n_batch:]
+    info['batch_levels'] = np.array([str(l) for l in batch_levels])
+    n_cells = adata.n_obs
+    chunks = [slice(start, min(start + chunk_size, n_cells))
+              for start in range(0, n_cells, chunk_size)]
+
+    fit_cells = _subsample_cells(codes, n_fit_cells, random_state)
+    if fit_cells is None:
+        fit_chunks, n_fit = chunks, n_cells
+    else:
+        fit_chunks = [fit_cells[start:start + chunk_size]
+                      for start in range(0, len(fit_cells), chunk_size)]
+        n_fit = len(fit_cells)
+
+    sys.stderr.write("Standardizing Data across genes.\n")
+    moments, done = None, 0
+    with _timed(info, 'standardize'):
+        for cells in fit_chunks:
+            chunk = _batch_moments(adata.X[cells], codes[cells], covariates[cells],
+                                   n_batch, block_size)
+            moments = chunk if moments is None else _add_moments(moments, chunk)
+            done += len(codes[cells])
+            sys.stderr.write("pass 1/2: %i/%i cells\n" % (done, n_fit))
+    params = _params_from_moments(moments, block_size=block_size, parametric=parametric,
+                                  n_prior_genes=n_prior_genes, random_state=random_state,
+                                  mean_only=mean_only, max_iter=max_iter, info=info)
 
     sys.stdout.write("Adjusting data\n")
-    bayesdata = s_data
-    gamma_star = np.array(gamma_star)
-    delta_star = np.array(delta_star)
+    layers = adata.file['/'].require_group('layers')
+    if not layers.attrs:
+        layers.attrs['encoding-type'] = 'dict'
+        layers.attrs['encoding-version'] = '0.1.0'
+    if layer in layers:
+        del layers[layer]
+    dtype = adata.X.dtype if np.issubdtype(adata.X.dtype, np.floating) else np.float64
+    out = layers.create_dataset(layer, shape=adata.shape, dtype=dtype,
+                                chunks=(min(chunk_size, n_cells), min(block_size, adata.n_vars)))
+    out.attrs['encoding-type'] = 'array'
+    out.attrs['encoding-version'] = '0.2.0'
+    with _timed(info, 'adjust'):
+        for cells in chunks:
+            out[cells] = _adjust_blocks(adata.X[cells], params, codes[cells],
+                                        covariates[cells], block_size)
+            sys.stderr.write("pass 2/2: %i/%i cells\n" % (cells.stop, n_cells))
+    _store_info(adata, info)
 
+class ComBatModel(object):
+    """ComBat fit that can be stored and re-applied to new cells.
 
-    for j, batch_idxs in enumerate(batch_info):
+    ``fit`` estimates the per-gene and per-batch parameters once, ``transform``
+    corrects any AnnData whose cells come from batches seen during ``fit``
+    without refitting, and ``save``/``load`` keep the parameters in a compact
+    ``.npz`` file.
 
-        dsq = np.sqrt(delta_star[j,:])
-        dsq = dsq.reshape((len(dsq), 1))
-        denom =  np.dot(dsq, np.ones((1, n_batches[j])))
-        numer = np.array(bayesdata[batch_idxs] - np.dot(batch_design.loc[batch_idxs], gamma_star).T)
+    ``fit_reference`` instead estimates the mean and variance of a single
+    reference batch. ``transform`` then adjusts every other batch towards the
+    reference, estimating (and caching) the parameters of batches it has not
+    seen before from their own cells only.
 
-        bayesdata[batch_idxs] = numer / denom
-   
-    vpsq = np.sqrt(var_pooled).reshape((len(var_pooled), 1))
-    bayesdata = bayesdata * np.dot(vpsq, np.ones((1, int(n_array)))) + stand_mean
-    
-    # put back into the adata object
-    data_f = bayesdata.as_matrix().transpose()
-    data_f = np.exp(data_f) - 1
-    data_f = scipy.sparse.csc_matrix(data_f)
-    adata.X = data_f
- 
-    #return bayesdata
-
-def it_sol(sdat, g_hat, d_hat, g_bar, t2, a, b, conv=0.0001):
-    n = (1 - np.isnan(sdat)).sum(axis=1)
+    The diagnostics of the last empirical-Bayes fit and the timings are kept
+    in ``info``, see ``adata.uns['combat']`` in ``combat``.
+
+    Parameters
+    ----------
+    block_size : int, optional (default: 1000)
+        Number of genes processed at a time, see ``combat``
+    n_jobs : int, optional (default: 1)
+        Number of processes, see ``combat``
+    parametric, n_prior_genes, random_state, mean_only, max_iter
+        Empirical-Bayes variant, see ``combat``
+    """
+
+    _arrays = ['batch_levels', 'covariates', 'var_names', 'grand_mean', 'B_cov',
+               'var_pooled', 'gamma_star', 'delta_star']
+    _options = ['block_size', 'parametric', 'n_prior_genes', 'random_state', 'mean_only',
+                'max_iter']
+
+    def __init__(self, block_size=1000, n_jobs=1, parametric=True, n_prior_genes=None,
+                 random_state=0, mean_only=False, max_iter=1000):
+        self.block_size = block_size
+        self.n_jobs = n_jobs
+        self.parametric = parametric
+        self.n_prior_genes = n_prior_genes
+        self.random_state = random_state
+        self.mean_only = mean_only
+        self.max_iter = max_iter
+        self.info = {}
+        self.batch_key = None
+        self.ref_batch = None
+
+    def fit(self, adata, batch, model=None, numerical_covariates=None):
+        """Estimate the ComBat parameters.
+
+        Parameters
+        ----------
+        adata : AnnData
+            Normalised, filtered data which has not yet been log transformed
+        batch : str or pandas.Series
+            Key in ``adata.obs`` or the batch of every cell
+        model : pandas.DataFrame, optional
+            Covariates to protect, see ``combat``
+        numerical_covariates : list-like, optional
+            Covariates in ``model`` which are numerical, see ``combat``
+
+        Returns
+        -------
+        self
+        """
+        if isinstance(batch, str):
+            self.batch_key = batch
+        self.info = {}
+        with _timed(self.info, 'design'):
+            design, _, batch_levels, covariates = _combat_design(adata, batch, model,
+                                                                 numerical_covariates)
+        n_batch = len(batch_levels)
+        self.info['batch_levels'] = np.array([str(l) for l in batch_levels])
+        params = _fit_blocks(adata.X, design, n_batch,
+                             self.block_size, self.n_jobs, parametric=self.parametric,
+                             n_prior_genes=self.n_prior_genes,
+                             random_state=self.random_state, mean_only=self.mean_only,
+                             max_iter=self.max_iter, info=self.info)
+        for key, value in params.items():
+            setattr(self, key, value)
+        self.batch_levels = np.array([str(l) for l in batch_levels])
+        self.covariates = np.array([str(c) for c in covariates])
+        self.var_names = np.array(adata.var_names, dtype=str)
+        return self
+
+    def fit_reference(self, adata, batch, ref_batch, model=None, numerical_covariates=None):
+        """Estimate the mean and variance of the reference batch ``ref_batch``.
+
+        Only the cells of the reference batch are used. Unlike sva, covariate
+        effects are estimated from the reference cells as well, so the
+        parameters of a new batch only depend on the reference and on its own
+        cells.
+
+        Parameters
+        ----------
+        adata : AnnData
+            Normalised, filtered data which has not yet been log transformed
+        batch : str or pandas.Series
+            Key in ``adata.obs`` or the batch of every cell
+        ref_batch
+            The reference batch. Its cells are left unchanged by ``transform``
+        model, numerical_covariates
+            Covariates to protect, see ``combat``
+
+        Returns
+        -------
+        self
+        """
+        if isinstance(batch, str):
+            self.batch_key = batch
+            batch = adata.obs[batch]
+        cells = np.flatnonzero(np.asarray(batch) == ref_batch)
+        if len(cells) < 2:
+            raise ValueError('The reference batch needs at least two cells.')
+        if model is not None:
+            model = model.iloc[cells].copy()
+        reference = adata[cells]
+        self.info = {}
+        with _timed(self.info, 'design'):
+            design, _, _, covariates = _combat_design(reference, np.asarray(batch)[cells],
+                                                      model, numerical_covariates)
+        covariates = np.array([str(c) for c in covariates], dtype=str)
+        with _timed(self.info, 'standardize'):
+            moments = _batch_moments(reference.X, np.zeros(len(cells), dtype=int),
+                                     design[:, 1:], 1, self.block_size)
+            fit = _fit_moments(moments, DesignFactor.from_design(design), self.mean_only)
+
+        self.ref_batch = str(ref_batch)
+        self.batch_levels = np.array([self.ref_batch])
+        self.covariates = covariates
+        self.var_names = np.array(adata.var_names, dtype=str)
+        self.grand_mean, self.B_cov = fit['grand_mean'], fit['B_hat'][1:]
+        self.var_pooled = fit['var_pooled']
+        # the reference batch is left as it is
+        self.gamma_star = np.zeros((1, adata.n_vars))
+        self.delta_star = np.ones((1, adata.n_vars))
+        return self
+
+    def _fit_batches(self, X, batch, levels, covariates):
+        """Estimate and cache the parameters of the new batches ``levels`` from
+        their cells in X, relative to the reference."""
+        cells = np.flatnonzero(np.isin(batch, levels))
+        codes = np.searchsorted(levels, batch[cells])
+        self.info['batch_levels'] = levels
+        with _timed(self.info, 'standardize'):
+            moments = _batch_moments(X[cells], codes, covariates[cells], len(levels),
+                                     self.block_size)
+            fit = _standardize_moments(moments, self.grand_mean, self.B_cov,
+                                       self.var_pooled, self.mean_only)
+        gamma_star, delta_star = _empirical_bayes(
+            fit['s_sums'], fit['s_sumsq'], moments['n'], fit['gamma_hat'], fit['delta_hat'],
+            parametric=self.parametric, n_prior_genes=self.n_prior_genes,
+            random_state=self.random_state, mean_only=self.mean_only,
+            max_iter=self.max_iter, info=self.info, n_jobs=self.n_jobs,
+            block_size=self.block_size)
+        self.batch_levels = np.concatenate([self.batch_levels, levels])
+        self.gamma_star = np.vstack([self.gamma_star, gamma_star])
+        self.delta_star = np.vstack([self.delta_star, delta_star])
+
+    def fit_stats(self, stats, batch_key=None):
+        """Estimate the ComBat parameters from (merged) ``combat_stats``.
+
+        Parameters
+        ----------
+        stats : dict
+            Output of ``combat_stats`` or ``merge_combat_stats``
+        batch_key : str, optional
+            Default key in ``adata.obs`` for ``transform``
+
+        Returns
+        -------
+        self
+        """
+        empty = stats['batch_levels'][stats['n'] == 0]
+        if len(empty) > 0:
+            raise ValueError('Batches {} have no cells.'.format(empty.tolist()))
+        self.info = {'batch_levels': np.asarray(stats['batch_levels'])}
+        params = _params_from_moments(stats, self.n_jobs, block_size=self.block_size,
+                                      parametric=self.parametric,
+                                      n_prior_genes=self.n_prior_genes,
+                                      random_state=self.random_state,
+                                      mean_only=self.mean_only, max_iter=self.max_iter,
+                                      info=self.info)
+        for key, value in params.items():
+            setattr(self, key, value)
+        for key in ['batch_levels', 'covariates', 'var_names']:
+            setattr(self, key, np.asarray(stats[key]))
+        self.batch_key = batch_key
+        return self
+
+    def transform(self, adata, batch=None, model=None, out=None, dtype=None):
+        """Correct ``adata.X`` in place with the fitted parameters.
+
+        Parameters
+        ----------
+        adata : AnnData
+            Cells from batches seen during ``fit``, same normalisation
+        batch : str or pandas.Series, optional
+            Key in ``adata.obs`` or the batch of every cell. Defaults to the key
+            used during ``fit``
+        model : pandas.DataFrame, optional
+            Must contain the covariate columns used during ``fit``
+        out : array-like, optional
+            Write the corrected values into this array instead, see ``combat``
+        dtype : numpy dtype, optional
+            dtype of the corrected data, defaults to the float dtype of
+            ``adata.X``
+        """
+        if batch is None:
+            batch = self.batch_key
+        if isinstance(batch, str):
+            batch = adata.obs[batch]
+        batch = np.array([str(b) for b in batch])
+
+        if len(self.covariates) > 0:
+            if model is None:
+                raise ValueError('The model was fitted with covariates {}, pass them '
+                                 'in `model`.'.format(self.covariates.tolist()))
+            covariates = np.asarray(model[list(self.covariates)], dtype=np.float64)
+        else:
+            covariates = np.zeros((adata.n_obs, 0))
+
+        genes = pd.Index(self.var_names).get_indexer(adata.var_names)
+        if (genes < 0).any():
+            raise ValueError('{} genes were not seen during fit.'.format(np.sum(genes < 0)))
+
+        unknown = np.setdiff1d(batch, self.batch_levels)
+        if len(unknown) > 0:
+            if self.ref_batch is None:
+                raise ValueError('Batches {} were not seen during fit.'.format(unknown.tolist()))
+            if not np.array_equal(genes, np.arange(len(self.var_names))):
+                raise ValueError('New batches can only be estimated on all genes of the '
+                                 'reference, in the same order.')
+            self._fit_batches(adata.X, batch, unknown, covariates)
+        order = np.argsort(self.batch_levels)
+        codes = order[np.searchsorted(self.batch_levels, batch, sorter=order)]
+        params = {'grand_mean': self.grand_mean[genes], 'B_cov': self.B_cov[:, genes],
+                  'var_pooled': self.var_pooled[genes],
+                  'gamma_star': self.gamma_star[:, genes], 'delta_star': self.delta_star[:, genes]}
+
+        with _timed(self.info, 'adjust'):
+            data_f = _adjust_blocks(adata.X, params, codes, covariates, self.block_size,
+                                    self.n_jobs, dtype=dtype, out=out)
+        if isinstance(data_f, np.ndarray):
+            adata.X = data_f
+
+    def save(self, filename):
+        """Write the fitted parameters to a compressed ``.npz`` file.
+
+        Only integer (or None) ``random_state`` seeds can be saved.
+        """
+        options = {key: getattr(self, key) for key in self._options}
+        if options['n_prior_genes'] is None:
+            options['n_prior_genes'] = 0
+        # seeds are non-negative, so -1 stands for None
+        if options['random_state'] is None:
+            options['random_state'] = -1
+        elif not isinstance(options['random_state'], (int, np.integer)):
+            raise ValueError('Only integer seeds can be saved, not `random_state={!r}`.'
+                             .format(options['random_state']))
+        np.savez_compressed(filename,
+                            batch_key='' if self.batch_key is None else self.batch_key,
+                            ref_batch='' if self.ref_batch is None else self.ref_batch,
+                            **dict(options, **{key: getattr(self, key) for key in self._arrays}))
+
+    @classmethod
+    def load(cls, filename):
+        """Read a model written by ``save``."""
+        with np.load(filename) as f:
+            self = cls(**{key: f[key].item() for key in cls._options})
+            self.n_prior_genes = self.n_prior_genes or None
+            if self.random_state < 0:
+                self.random_state = None
+            self.batch_key = str(f['batch_key']) or None
+            self.ref_batch = str(f['ref_batch']) or None
+            for key in self._arrays:
+                setattr(self, key, f[key])
+        return self
+
+def _empirical_bayes(s_sums, s_sumsq, n, gamma_hat, delta_hat, parametric=True,
+                     n_prior_genes=None, random_state=0, mean_only=False, max_iter=1000,
+                     info=None, n_jobs=1, block_size=1000):
+    """Empirical-Bayes location/scale estimates from the per-batch sums and
+    sums of squares of the standardized data. Returns gamma_star, delta_star.
+
+    With ``mean_only`` the scale is fixed to 1, as in sva, ``s_sumsq`` and
+    ``delta_hat`` are ignored and no iteration is needed. ``max_iter`` caps
+    the iterations of the parametric solver. If ``info`` is a dict, the
+    priors, the estimates, the per-batch iteration counts and the number of
+    genes which did not converge are stored in it and the time spent in the
+    ``'priors'`` and ``'eb_solve'`` phases is added to ``info['timings']``.
+    """
+    if info is None:
+        info = {}
+    if mean_only:
+        delta_star = np.ones(gamma_hat.shape)
+        if not parametric:
+            sys.stderr.write("Finding nonparametric adjustments\n")
+            with _timed(info, 'eb_solve'):
+                # with unit variances the sums of squares only add a constant per gene
+                # to the log likelihoods, which cancels in the weights
+                gamma_star = int_eprior(s_sums, np.zeros(gamma_hat.shape), n, gamma_hat,
+                                        delta_star, n_prior_genes, block_size, random_state,
+                                        n_jobs)[0]
+        else:
+            sys.stderr.write("Finding parametric adjustments\n")
+            with _timed(info, 'priors'):
+                gamma_bar = gamma_hat.mean(axis=1)
+                t2 = gamma_hat.var(axis=1)
+            with _timed(info, 'eb_solve'):
+                gamma_star = postmean(gamma_hat, gamma_bar[:, None], 1, 1, t2[:, None])
+            info.update(gamma_bar=gamma_bar, t2=t2)
+        info.update(gamma_star=gamma_star, delta_star=delta_star)
+        return gamma_star, delta_star
+
+    if not parametric:
+        sys.stderr.write("Finding nonparametric adjustments\n")
+        with _timed(info, 'eb_solve'):
+            gamma_star, delta_star = int_eprior(s_sums, s_sumsq, n, gamma_hat, delta_hat,
+                                                n_prior_genes, block_size, random_state,
+                                                n_jobs)
+        info.update(gamma_star=gamma_star, delta_star=delta_star)
+        return gamma_star, delta_star
+
+    with _timed(info, 'priors'):
+        gamma_bar = gamma_hat.mean(axis=1)
+        t2 = gamma_hat.var(axis=1)
+        a_prior = np.array(list(map(aprior, delta_hat)))
+        b_prior = np.array(list(map(bprior, delta_hat)))
+
+    sys.stderr.write("Finding parametric adjustments\n")
+    with _timed(info, 'eb_solve'):
+        if n_jobs == 1:
+            results = [it_sol_batched(s_sums, s_sumsq, n, gamma_hat, delta_hat, gamma_bar, t2,
+                                      a_prior, b_prior, max_iter=max_iter, full_output=True)]
+        else:
+            # only the shared priors couple the genes
+            shards = _shards(gamma_hat.shape[1], n_jobs)
+            with Pool(n_jobs) as pool:
+                results = pool.starmap(it_sol_batched, [
+                    (s_sums[:, g], s_sumsq[:, g], n, gamma_hat[:, g], delta_hat[:, g],
+                     gamma_bar, t2, a_prior, b_prior, 0.0001, max_iter, True) for g in shards])
+    gamma_star = np.hstack([r[0] for r in results])
+    delta_star = np.hstack([r[1] for r in results])
+    n_iter = np.max([r[2] for r in results], axis=0)
+    n_unconverged = np.sum([r[3] for r in results], axis=0)
+    if n_unconverged.any():
+        sys.stderr.write("Warning: {} genes did not converge within {} iterations\n".format(
+            n_unconverged.sum(), max_iter))
+    info.update(gamma_bar=gamma_bar, t2=t2, a_prior=a_prior, b_prior=b_prior,
+                gamma_star=gamma_star, delta_star=delta_star, n_iter=n_iter,
+                n_unconverged=n_unconverged)
+    return gamma_star, delta_star
+
+def _store_info(adata, info):
+    """Store the diagnostics of a fit in ``adata.uns['combat']`` and summarise
+    the timings and iteration counts on stderr."""
+    adata.uns['combat'] = info
+    sys.stderr.write("Timings: {}\n".format(', '.join(
+        '{} {:.2f}s'.format(phase, t) for phase, t in info.get('timings', {}).items())))
+    if 'peak_bytes' in info:
+        peak = info['peak_bytes']
+        sys.stderr.write("Peak memory allocated: %i bytes (%.1f MB)\n" % (peak, peak / 2.**20))
+    if 'n_iter' in info:
+        sys.stderr.write("Iterations per batch: {}\n".format(', '.join(
+            '{} {}'.format(l, i) for l, i in zip(info['batch_levels'], info['n_iter']))))
+
+@contextmanager
+def _timed(info, phase):
+    """Add the wall time spent in the block to ``info['timings'][phase]``."""
+    start = time.time()
+    try:
+        yield
+    finally:
+        if info is not None:
+            timings = info.setdefault('timings', {})
+            timings[phase] = timings.get(phase, 0) + time.time() - start
+
+def _shards(n_genes, n_shards):
+    return [slice(g[0], g[-1] + 1) for g in
+            np.array_split(np.arange(n_genes), n_shards) if len(g)]
+
+def int_eprior(s_sums, s_sumsq, n, g_hat, d_hat, n_prior_genes=None, block_size=1000,
+               random_state=0, n_jobs=1):
+    """Non-parametric empirical-Bayes estimates for all batches.
+
+    As ``int.eprior`` in sva, every gene's gamma/delta is the average of the
+    other genes' estimates weighted by the likelihood of its data under them.
+    The residual sums of squares come from the per-batch sums and sums of
+    squares of the standardized data, the likelihoods are evaluated in the log
+    domain ``block_size`` genes at a time, and ``n_prior_genes`` restricts the
+    integration to a random subsample of genes per batch, which makes the cost
+    O(n_genes * n_prior_genes) instead of O(n_genes**2).
+    """
+    rng = np.random.RandomState(random_state)
+    n_batch, n_genes = g_hat.shape
+    keys, tasks = [], []
+    for i in range(n_batch):
+        if n_prior_genes is None or n_prior_genes >= n_genes:
+            prior = np.arange(n_genes)
+        else:
+            prior = np.sort(rng.choice(n_genes, n_prior_genes, replace=False))
+        # genes that are constant within the batch carry no likelihood, as in sva
+        # where their likelihood under- or overflows to NaN and is set to zero
+        prior = prior[d_hat[i, prior] > 1e-8]
+        for genes in _shards(n_genes, n_jobs):
+            # position of each gene in its own prior, so it can be left out
+            idx = np.arange(genes.start, genes.stop)
+            pos = np.minimum(np.searchsorted(prior, idx), len(prior) - 1)
+            own = np.where(prior[pos] == idx, pos, -1)
+            keys.append((i, genes))
+            tasks.append((s_sums[i, genes], s_sumsq[i, genes], n[i],
+                          g_hat[i, prior], d_hat[i, prior], own, block_size))
+
+    if n_jobs > 1:
+        with Pool(n_jobs) as pool:
+            results = pool.starmap(_eprior_genes, tasks)
+    else:
+        results = [_eprior_genes(*task) for task in tasks]
+    g_star, d_star = np.empty(g_hat.shape), np.empty(g_hat.shape)
+    for (i, genes), (g, d) in zip(keys, results):
+        g_star[i, genes] = g
+        d_star[i, genes] = d
+    return g_star, d_star
+
+def _eprior_genes(s_sum, s_sumsq, n, g, d, own, block_size):
+    """``int_eprior`` for some genes of one batch, integrating over the prior
+    estimates ``g``, ``d``. ``own`` is each gene's position in the prior or -1."""
+    log_norm = -0.5 * n * np.log(2 * np.pi * d)
+    g_star, d_star = np.empty(len(s_sum)), np.empty(len(s_sum))
+    for genes in _blocks(len(s_sum), block_size):
+        sum2 = s_sumsq[genes, None] - 2 * s_sum[genes, None] * g + n * g**2
+        log_lh = log_norm - sum2 / (2 * d)
+        rows = np.flatnonzero(own[genes] >= 0)
+        log_lh[rows, own[genes][rows]] = -np.inf
+        lh = np.exp(log_lh - log_lh.max(axis=1, keepdims=True))
+        total = lh.sum(axis=1)
+        g_star[genes] = np.dot(lh, g) / total
+        d_star[genes] = np.dot(lh, d) / total
+    return g_star, d_star
+
+def it_sol_batched(s_sums, s_sumsq, n, g_hat, d_hat, g_bar, t2, a, b, conv=0.0001,
+                   max_iter=1000, full_output=False):
+    """Iterative empirical-Bayes solver of sva for all batches and genes at once.
+
+    ``s_sums``, ``s_sumsq``, ``g_hat`` and ``d_hat`` are (n_batch, n_genes)
+    arrays holding the per-batch sums and sums of squares of the standardized
+    data and the initial estimates; ``n``, ``g_bar``, ``t2``, ``a`` and ``b``
+    hold one value per batch. The data is never re-read during the iteration
+    and genes are frozen as soon as they have converged in their batch, or
+    after ``max_iter`` iterations.
+
+    Returns gamma_star, delta_star and, with ``full_output``, the number of
+    iterations each batch needed and the number of genes per batch that did
+    not converge.
+    """
+    n_genes = g_hat.shape[1]
+    n, g_bar, t2, a, b = [np.asarray(v, dtype=np.float64) for v in (n, g_bar, t2, a, b)]
+    g_hat, s_sums, s_sumsq = g_hat.ravel(), s_sums.ravel(), s_sumsq.ravel()
     g_old = g_hat.copy()
-    d_old = d_hat.copy()
+    d_old = np.array(d_hat, dtype=np.float64).ravel()
 
-    change = 1
+    active = np.arange(g_hat.size)
+    n_iter = np.zeros(g_hat.size, dtype=int)
     count = 0
-    while change > conv:
-        #print g_hat.shape, g_bar.shape, t2.shape
-        g_new = postmean(g_hat, g_bar, n, d_old, t2)
-        sum2 = ((sdat - np.dot(g_new.values.reshape((g_new.shape[0], 1)), np.ones((1, sdat.shape[1])))) ** 2).sum(axis=1)
-        d_new = postvar(sum2, n, a, b)
-       
-        change = max((abs(g_new - g_old) / g_old).max(), (abs(d_new - d_old) / d_old).max())
-        g_old = g_new #.copy()
-        d_old = d_new #.copy()
-        count = count + 1
-    adjust = (g_new, d_new)
-    return adjust 
+    while active.size and count < max_iter:
+        bi = active // n_genes
+        g_new = postmean(g_hat[active], g_bar[bi], n[bi], d_old[active], t2[bi])
+        sum2 = s_sumsq[active] - 2 * g_new * s_sums[active] + n[bi] * g_new**2
+        d_new = postvar(sum2, n[bi], a[bi], b[bi])
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            change = np.fmax(abs(g_new - g_old[active]) / g_old[active],
+                             abs(d_new - d_old[active]) / d_old[active])
+        g_old[active] = g_new
+        d_old[active] = d_new
+        n_iter[active] += 1
+        count += 1
+        active = active[change > conv]
+    g_star, d_star = g_old.reshape(-1, n_genes), d_old.reshape(-1, n_genes)
+    if not full_output:
+        return g_star, d_star
+    n_batch = g_star.shape[0]
+    unconverged = np.bincount(active // n_genes, minlength=n_batch)
+    return g_star, d_star, n_iter.reshape(n_batch, -1).max(axis=1), unconverged
 
     
 
 def aprior(gamma_hat):
     m = gamma_hat.mean()
-    s2 = gamma_hat.var()
+    s2 = gamma_hat.var(ddof=1)
     return (2 * s2 +m**2) / s2
 
 def bprior(gamma_hat):
     m = gamma_hat.mean()
-    s2 = gamma_hat.var()
+    s2 = gamma_hat.var(ddof=1)
     return (m*s2+m**3)/s2
 
 def postmean(g_hat, g_bar, n, d_star, t2):
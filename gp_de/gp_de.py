@@ -3,11 +3,16 @@ def timeseries_smooth(adata, genes= 'none', gene_symbols= 'none',
               n_restarts_optimizer = 10, likelihood_landscape = False, normalize_y=False,
               noise_level = 0.5, noise_level_bounds = (1e-2, 1e+1), 
               length_scale = 1, length_scale_bounds = (1e-2, 1e+1), 
-              save = 'none', title = 'long'):
+              save = 'none', title = 'long', kernel_groups = None, n_inducing = None, 
+              n_grid = 1000, n_jobs = 1, parallel_restarts = False, n_bins = None, 
+              cache_dir = None, method = 'gp', bandwidth = 0.05):
     
     """
     Plot a timeseries of some genes in pseudotime
     
+    Fits the genes with smooth_genes, or with kernel_smooth for a quick look, and 
+    plots them with plot_smooth.
+    
     Keyword arguments:
     adata -- anndata object
     genes -- list of genes. If 'none', the first 5 genes are plotted
@@ -15,114 +20,325 @@ def timeseries_smooth(adata, genes= 'none', gene_symbols= 'none',
     key -- observation annotation. 
     groups -- basically branches, chosen from the annotations in key
     style -- line plotting style
+    kernel_groups -- None to fit the kernel hyperparameters of every gene 
+        separately, 'all' to share them between all genes or one label per gene 
+        to share them within groups of genes, e.g. genes with similar length 
+        scales. See fit_gp
+    n_inducing -- if given, use a sparse GP with this many inducing points along 
+        the pseudotime instead of the exact GP, which costs O(n_cells * n_inducing**2) 
+        instead of O(n_cells**3). See SparseGP
+    n_grid -- number of pseudotime points the curves are evaluated on
+    n_jobs, parallel_restarts -- fit the genes, and optionally the optimiser 
+        restarts, in a pool of n_jobs processes. See fit_gp
+    n_bins -- if given, fit the GP to at most this many adaptive pseudotime bins 
+        instead of the cells, weighting every bin by its number of cells. The cost 
+        then does not grow with the number of cells. See bin_pseudotime
+    cache_dir -- directory to cache the fitted hyperparameters in, so that plotting 
+        the same genes again does not refit them. See fit_gp
+    method -- 'gp' for Gaussian processes or 'kernel' for the much faster Gaussian 
+        kernel smoother of kernel_smooth, which ignores the GP options
+    bandwidth -- bandwidth of the kernel smoother in units of pseudotime
+    """
+    
+    if method == 'kernel':
+        result = kernel_smooth(adata, genes=genes, gene_symbols=gene_symbols, key=key, 
+                               groups=groups, bandwidth=bandwidth, n_grid=n_grid, key_added=None)
+        plot_smooth(adata, result, style=style, likelihood_landscape=likelihood_landscape, 
+                    save=save, title=title)
+        return
+    elif method != 'gp':
+        raise ValueError("method has to be 'gp' or 'kernel', got {}.".format(method))
+    
+    result = smooth_genes(adata, genes=genes, gene_symbols=gene_symbols, key=key, groups=groups, 
+                          n_restarts_optimizer=n_restarts_optimizer, normalize_y=normalize_y, 
+                          noise_level=noise_level, noise_level_bounds=noise_level_bounds, 
+                          length_scale=length_scale, length_scale_bounds=length_scale_bounds, 
+                          kernel_groups=kernel_groups, n_inducing=n_inducing, n_grid=n_grid, 
+                          n_jobs=n_jobs, parallel_restarts=parallel_restarts, n_bins=n_bins, 
+                          cache_dir=cache_dir, key_added=None)
+    plot_smooth(adata, result, style=style, likelihood_landscape=likelihood_landscape, 
+                save=save, title=title)
+
+
+def smooth_genes(adata, genes= 'none', gene_symbols= 'none', key = 'louvain', groups = 'all', 
+                 n_restarts_optimizer = 10, normalize_y = False, 
+                 noise_level = 0.5, noise_level_bounds = (1e-2, 1e+1), 
+                 length_scale = 1, length_scale_bounds = (1e-2, 1e+1), 
+                 kernel_groups = None, n_inducing = None, n_grid = 1000, n_jobs = 1, 
+                 parallel_restarts = False, n_bins = None, cache_dir = None, 
+                 key_added = 'gp_smooth'):
+    
+    """
+    Smooth some genes in pseudotime with Gaussian processes, without plotting
+    
+    Keyword arguments:
+    adata -- anndata object
+    genes, gene_symbols, key, groups -- selection of genes and cells, see timeseries_smooth
+    n_restarts_optimizer, normalize_y, n_jobs, parallel_restarts -- see fit_gp
+    noise_level, noise_level_bounds, length_scale, length_scale_bounds -- initial 
+        hyperparameters of the kernel C * RBF + WhiteKernel and their bounds
+    kernel_groups, n_inducing, n_bins, cache_dir -- see timeseries_smooth
+    n_grid -- number of evenly spaced pseudotime points the curves are evaluated on. 
+        Only pointwise variances are computed, so the cost is linear in n_grid
+    key_added -- the result is also stored in adata.uns[key_added]. If None, it is 
+        only returned
+    
+    Returns a dict with
+    genes -- names of the smoothed genes
+    grid -- the pseudotime grid the curves are evaluated on, shape (n_grid,)
+    mean, std -- posterior mean and standard deviation on the grid, shape (n_genes, n_grid)
+    kernel_params -- optimised hyperparameters, shape (n_genes, n_hyperparameters), 
+        named in kernel_param_names
+    log_marginal_likelihood -- of every gene at its optimum
+    settings -- the selection and kernel options, used by plot_smooth
     """
     
-    import pandas as pd
     import numpy as np
-    import matplotlib.pyplot as plt
-    import matplotlib.colors as colors
-    from sklearn.gaussian_process import GaussianProcessRegressor
-    from sklearn.gaussian_process.kernels import RBF, ConstantKernel as C, WhiteKernel
     
-    # select one branch
-    if groups != 'all':
-        adata_selected = adata[np.in1d(adata.obs[key], groups)]
+    X, Y, genes = _pseudotime_data(adata, genes, gene_symbols, key, groups)
+    
+    # Mesh the input space for evaluations of the prediction and
+    # its MSE
+    x = np.atleast_2d(np.linspace(0, 1, n_grid)).T
+    
+    # Initiate a Gaussian process modell. We use a sum of two kernels here, this allows 
+    # us to estimate the noice level via optimisation of the marginal likelihood as well
+    kernel = _gp_kernel(length_scale, length_scale_bounds, noise_level, noise_level_bounds)
+    # the cache is keyed by the genes, the selection of cells and the data itself
+    cache = {'cache_dir': cache_dir, 'gene_names': genes, 'cache_key': '{} {}'.format(key, groups)}
+    if n_bins is not None:
+        # fit the means of pseudotime bins, the noise of a bin shrinks with its size
+        X_bins, Y_bins, variances, counts = bin_pseudotime(X, Y, n_bins)
+        gps, columns = fit_gp(X_bins, Y_bins, kernel, kernel_groups, 
+                              n_restarts_optimizer=n_restarts_optimizer, normalize_y=normalize_y, 
+                              n_inducing=n_inducing, n_jobs=n_jobs, 
+                              parallel_restarts=parallel_restarts, counts=counts, 
+                              variances=variances, **cache)
     else:
-        adata_selected = adata
-        
-    # select genes
-    if genes == 'none':
-        
-        # no genes specified, we just use the first 5
-        genes = adata_selected.var_names.values[0:5]
-        m = {'Mapped': genes, 'Original': genes}
-        
-    elif gene_symbols != 'none':
-        
-        # a gene annotation is used, we map the gene names
-        mapping_table = pd.DataFrame(adata_selected.var[gene_symbols])
-        name_mapping = mapping_table.set_index(gene_symbols)
-        name_mapping['Ensembl'] = mapping_table.index
-        genes_mapped = name_mapping.loc[genes, :]
-        
-        
-        # save in dict
-        m = {'Mapped': genes_mapped['Ensembl'], 'Original': genes}
+        gps, columns = fit_gp(X, Y, kernel, kernel_groups, 
+                              n_restarts_optimizer=n_restarts_optimizer, normalize_y=normalize_y, 
+                              n_inducing=n_inducing, n_jobs=n_jobs, 
+                              parallel_restarts=parallel_restarts, **cache)
+    
+    # obtain a prediction from the models, once per group of genes sharing a kernel
+    n_genes = Y.shape[1]
+    y_means, y_stds = np.empty((n_genes, len(x))), np.empty((n_genes, len(x)))
+    lml = np.empty(n_genes)
+    for gp, group in _unique_gps(gps):
+        # Also return the pointwise standard deviation, so we can calculate
+        # confidence intervals. Only the diagonal of the predictive covariance is
+        # computed, never the n_grid x n_grid matrix
+        y_mean, y_std = gp.predict(x, return_std=True)
+        y_mean, y_std = y_mean.reshape(len(x), -1), y_std.reshape(len(x), -1)
+        y_means[group], y_stds[group] = y_mean[:, columns[group]].T, y_std[:, columns[group]].T
+        lml[group] = gene_log_marginal_likelihood(gp)[columns[group]]
+    
+    result = {'genes': genes, 'grid': x.ravel(), 'mean': y_means, 'std': y_stds, 
+              'kernel_params': np.exp([gp.kernel_.theta for gp in gps]), 
+              'kernel_param_names': np.array([h.name for h in kernel.hyperparameters]), 
+              'log_marginal_likelihood': lml, 
+              'settings': {'method': 'gp', 'gene_symbols': gene_symbols, 'key': key, 
+                           'groups': groups, 'normalize_y': normalize_y, 
+                           'n_inducing': 0 if n_inducing is None else n_inducing, 
+                           'n_bins': 0 if n_bins is None else n_bins, 
+                           'length_scale': length_scale, 
+                           'length_scale_bounds': np.array(length_scale_bounds), 
+                           'noise_level': noise_level, 
+                           'noise_level_bounds': np.array(noise_level_bounds)}}
+    if key_added is not None:
+        adata.uns[key_added] = result
+    return result
+
+
+def kernel_smooth(adata, genes= 'none', gene_symbols= 'none', key = 'louvain', groups = 'all', 
+                  bandwidth = 0.05, n_grid = 1000, key_added = 'kernel_smooth'):
+    
+    """
+    Smooth some genes in pseudotime with a Gaussian kernel smoother
+    
+    A fast alternative to smooth_genes for exploratory plots of many genes, see 
+    kernel_smoother. The expression is read from adata.X without densifying it. 
+    The outputs fit utils.plot_gene: x_test is the grid, x_mean, x_cov and 
+    x_grad are the mean, var and grad of a gene.
+    
+    Keyword arguments:
+    adata -- anndata object
+    genes, gene_symbols, key, groups -- selection of genes and cells, see timeseries_smooth
+    bandwidth -- standard deviation of the Gaussian kernel, in units of pseudotime
+    n_grid -- number of evenly spaced pseudotime points the curves are evaluated on
+    key_added -- the result is also stored in adata.uns[key_added]. If None, it is 
+        only returned
+    
+    Returns a dict with
+    genes -- names of the smoothed genes
+    grid -- the pseudotime grid the curves are evaluated on, shape (n_grid,)
+    mean, var, grad -- smoothed expression, its pointwise variance and its derivative 
+        with respect to the pseudotime, shape (n_genes, n_grid)
+    std -- square root of var, as in the result of smooth_genes
+    settings -- the selection and the bandwidth, used by plot_smooth
+    """
+    
+    import numpy as np
+    
+    X, Y, genes = _pseudotime_data(adata, genes, gene_symbols, key, groups, densify=False)
+    x = np.linspace(0, 1, n_grid)
+    mean, var, grad = kernel_smoother(X, Y, x, bandwidth)
+    
+    result = {'genes': genes, 'grid': x, 'mean': mean, 'std': np.sqrt(var), 'var': var, 
+              'grad': grad, 
+              'settings': {'method': 'kernel', 'gene_symbols': gene_symbols, 'key': key, 
+                           'groups': groups, 'bandwidth': bandwidth}}
+    if key_added is not None:
+        adata.uns[key_added] = result
+    return result
+
+
+def kernel_smoother(X, Y, grid, bandwidth = 0.05):
+    
+    """
+    Nadaraya-Watson smoother with a Gaussian kernel for many genes which share 
+    the inputs X
+    
+    The cells are first linearly binned onto a regular grid with a spacing of a 
+    tenth of the bandwidth, one sparse product with Y that is linear in the number 
+    of cells and never densifies a sparse Y. The kernel weights are then only 
+    applied to the bins, so smoothing costs O(n_grid * n_bins * n_genes) regardless 
+    of the number of cells. With S_k(x) = sum_i K(x - t_i) y_i**k the mean is 
+    S_1 / S_0, its derivative follows from the derivative of the kernel and its 
+    variance is the local variance of the cells around the mean times 
+    sum_i K(x - t_i)**2 / S_0**2. Far away from all cells the curves are nan.
+    
+    Keyword arguments:
+    X -- pseudotime, shape (n_cells, 1)
+    Y -- expression, dense or sparse, shape (n_cells, n_genes)
+    grid -- points the curves are evaluated on
+    bandwidth -- standard deviation of the Gaussian kernel
+    
+    Returns the mean, the pointwise variance of the mean and the derivative of the 
+    mean of every gene on the grid, each of shape (n_genes, n_grid).
+    """
+    
+    import numpy as np
+    from scipy.sparse import csr_matrix, issparse
+    
+    t = np.asarray(X, dtype=float).ravel()
+    grid = np.asarray(grid, dtype=float).ravel()
+    if not issparse(Y):
+        Y = np.asarray(Y, dtype=float).reshape(len(t), -1)
+    
+    # linear binning: every cell is split between its two neighbouring bins
+    n_bins = max(int(np.ceil((t.max() - t.min()) / (bandwidth / 10))), 1) + 1
+    centres = np.linspace(t.min(), t.max(), n_bins)
+    position = (t - t.min()) / max(centres[1] - centres[0], 1e-12)
+    lower = np.minimum(np.floor(position).astype(int), n_bins - 2)
+    frac = np.clip(position - lower, 0, 1)
+    cells = np.arange(len(t))
+    B = csr_matrix((np.concatenate([1 - frac, frac]), 
+                    (np.concatenate([lower, lower + 1]), np.concatenate([cells, cells]))), 
+                   shape=(n_bins, len(t)))
+    
+    S0 = np.asarray(B.sum(axis=1))
+    if issparse(Y):
+        S1, S2 = (B @ Y).toarray(), (B @ Y.multiply(Y)).toarray()
     else:
-        m = {'Mapped': genes, 'Original': genes}
-        
-    # construct a look up table
-    gene_table = pd.DataFrame(data = m)
+        S1, S2 = B @ Y, B @ Y**2
     
-    # extract the pseudotime
-    time = adata_selected.obs['dpt_pseudotime']
+    # kernel and its derivative with respect to the grid point, between grid and bins
+    D = grid[:, None] - centres[None, :]
+    K = np.exp(-0.5 * (D / bandwidth)**2)
+    K_grad = -D / bandwidth**2 * K
     
+    with np.errstate(divide='ignore', invalid='ignore'):
+        s0, s0_grad, s0_sq = np.dot(K, S0), np.dot(K_grad, S0), np.dot(K**2, S0)
+        mean = np.dot(K, S1) / s0
+        grad = (np.dot(K_grad, S1) - mean * s0_grad) / s0
+        noise = np.maximum(np.dot(K, S2) / s0 - mean**2, 0)
+        var = noise * s0_sq / s0**2
+    return mean.T, var.T, grad.T
+
+
+def plot_smooth(adata, result = 'gp_smooth', genes = None, style = '-b', 
+                likelihood_landscape = False, save = 'none', title = 'long'):
     
-    # construct a data frame which has time as index
-    exp_data = pd.DataFrame(data = adata_selected[:, gene_table['Mapped']].X, 
-                            index = time, columns=[gene_table['Original'].values])
+    """
+    Plot the output of smooth_genes or kernel_smooth together with the observations
     
-    # sort according to pseudotime
-    exp_data.sort_index(inplace = True)
-    ()
+    Keyword arguments:
+    adata -- anndata object the result was computed on
+    result -- dict returned by smooth_genes or kernel_smooth, or its key in adata.uns
+    genes -- subset of the smoothed genes to plot. If None, all are plotted
+    style -- line plotting style
+    likelihood_landscape -- also plot the log-marginal-likelihood of every gene 
+        over length scales and noise levels. Only for results of smooth_genes, 
+        evaluated on the same pseudotime bins if these were fitted to bins
+    save -- if not 'none', prefix of the pdf files the plots are saved to
+    title -- 'long' for a title with the kernels and the log-marginal-likelihood
+    """
     
-    # remove the last entry
-    (m, n) = exp_data.shape
-    exp_data = exp_data.iloc[:m-1, :]
+    import numpy as np
+    import matplotlib.pyplot as plt
+    import matplotlib.colors as colors
+    
+    if isinstance(result, str):
+        result = adata.uns[result]
+    settings = result['settings']
+    gp = settings.get('method', 'gp') == 'gp'
+    if likelihood_landscape and not gp:
+        raise ValueError('The likelihood landscape needs a result of smooth_genes.')
+    all_genes = list(result['genes'])
+    if genes is None:
+        genes = all_genes
+    X, Y, _ = _pseudotime_data(adata, genes, settings['gene_symbols'], settings['key'], 
+                               settings['groups'])
+    x = result['grid']
+    if gp:
+        kernel = _gp_kernel(settings['length_scale'], tuple(settings['length_scale_bounds']), 
+                            settings['noise_level'], tuple(settings['noise_level_bounds']))
     
     # loop counter
     i = 0
 
     # loop over all genes we wish to plot
-    for index, row in gene_table.iterrows():   
+    for j, gene in enumerate(genes):   
         
-        # select data
-        data_selected = exp_data.loc[:, row['Original']].reset_index()
-        
-        # create the labels
-        X = np.atleast_2d(data_selected['dpt_pseudotime'].values)
-       
-        # create the targets
-        y = data_selected[row['Original']].values.ravel()
-        
-        # Mesh the input space for evaluations of the prediction and
-        # its MSE
-        x = np.atleast_2d(np.linspace(0, 1, 1000)).T
-        
-        # Initiate a Gaussian process modell. We use a sum of two kernels here, this allows 
-        # us to estimate the noice level via optimisation of the marginal likelihood as well
-        kernel = 1.0 * RBF(length_scale=length_scale, length_scale_bounds=length_scale_bounds) \
-        + WhiteKernel(noise_level=noise_level, noise_level_bounds=noise_level_bounds)
-        gp = GaussianProcessRegressor(kernel=kernel, alpha=0.0, 
-                                      n_restarts_optimizer=n_restarts_optimizer, 
-                                    normalize_y=normalize_y).fit(X, y)
-        
-        # obtain a prediction from this model. Also return the covariance matrix, so we can calculate
-        # confidence intervals
-        y_mean, y_cov = gp.predict(x, return_cov=True)
+        g = all_genes.index(gene)
+        y = Y[:, j]
+        y_mean, y_std = result['mean'][g], result['std'][g]
+        if gp:
+            kernel_ = kernel.clone_with_theta(np.log(result['kernel_params'][g]))
         
         # plot current genes
         plt.figure(num=i, figsize=(8, 6), dpi=80, facecolor='w', edgecolor='k')
         plt.plot(x, y_mean, 'k', lw=3, zorder=9, label = 'Prediction')
-        plt.fill_between(x.ravel(), y_mean - np.sqrt(np.diag(y_cov)),
-                 y_mean + np.sqrt(np.diag(y_cov)),
+        plt.fill_between(x.ravel(), y_mean - y_std,
+                 y_mean + y_std,
                  alpha=0.5, color='k')
         plt.scatter(X, y, c='r', s=50, zorder=10, edgecolors=(0, 0, 0), label= 'Observation')
-        if title == 'long':
+        if title == 'long' and not gp:
+            plt.title("Gene: %s\nGaussian kernel smoother, bandwidth: %s"
+                      % (gene, settings['bandwidth']))
+        elif title == 'long':
             plt.title("Gene: %s\nInitial: %s\nOptimum: %s\nLog-Marginal-Likelihood: %s"
-                      % (row['Original'], kernel, gp.kernel_,
-                         gp.log_marginal_likelihood(gp.kernel_.theta)))
+                      % (gene, kernel, kernel_, result['log_marginal_likelihood'][g]))
         else:
              plt.title("Gene: %s"
-                       % (row['Original']))   
+                       % (gene))   
         plt.xlabel('$t_{pseudo}$')
         plt.ylabel('Expression')
         plt.legend(loc='upper left')
         if save != 'none':
-            plt.savefig(save + row['Original'] + '_dynamics.pdf')
+            plt.savefig(save + gene + '_dynamics.pdf')
         
         
         if likelihood_landscape == True:
+            
+            # the gene on its own, with the approximation it was fitted with
+            n_inducing, n_bins = settings['n_inducing'], settings.get('n_bins', 0)
+            Z = inducing_points(X, n_inducing) if n_inducing and n_inducing < len(X) else None
+            if n_bins:
+                X_fit, y_fit, variances, counts = bin_pseudotime(X, y, n_bins)
+            else:
+                X_fit, y_fit, variances, counts = X, y, None, None
         
         # Plot LML landscape
             i += 1
@@ -130,9 +346,9 @@ def timeseries_smooth(adata, genes= 'none', gene_symbols= 'none',
             theta0 = np.logspace(-2, 3, 49) # length scale
             theta1 = np.logspace(-1.5, 0, 50) # Noise level
             Theta0, Theta1 = np.meshgrid(theta0, theta1)
-            LML = [[gp.log_marginal_likelihood(np.log([0.36, Theta0[i, j], Theta1[i, j]]))
-                    for i in range(Theta0.shape[0])] for j in range(Theta0.shape[1])]
-            LML = np.array(LML).T
+            LML = log_marginal_likelihood_grid(X_fit, y_fit, theta0, theta1, constant=0.36, 
+                                               normalize_y=settings['normalize_y'], Z=Z, 
+                                               counts=counts, variances=variances)
 
             vmin, vmax = (-LML).min(), (-LML).max()
             #vmax = 50
@@ -150,4 +366,882 @@ def timeseries_smooth(adata, genes= 'none', gene_symbols= 'none',
             
         # increase loop counter
         i += 1
-        
\ No newline at end of file
+
+
+def pseudotime_de_test(adata, genes = None, key = 'louvain', groups = 'all', 
+                       n_restarts_optimizer = 2, normalize_y = True, 
+                       noise_level = 0.5, noise_level_bounds = (1e-2, 1e+1), 
+                       length_scale = 1, length_scale_bounds = (1e-2, 1e+1), 
+                       n_inducing = None, min_variance = 1e-3, chunk_size = 500, 
+                       n_jobs = 1, cache_dir = None, key_added = 'gp_de'):
+    
+    """
+    Test all genes for changes in expression along the pseudotime
+    
+    Every gene is centred and fitted with the kernel C * RBF + WhiteKernel of 
+    timeseries_smooth and with a constant null model, i.e. white noise only, whose 
+    maximum likelihood noise level is the variance of the gene. The likelihood 
+    ratio statistic 2 * (LML - LML_null) is compared to a chi-squared distribution 
+    with one degree of freedom, p-values are corrected with Benjamini-Hochberg. 
+    
+    Both models have to be fitted within the same noise bounds. With normalize_y 
+    every gene is standardised before fitting, so its null noise level is 1, 
+    without it the null noise level is the variance of the gene. It has to lie 
+    within noise_level_bounds, otherwise a ValueError is raised: the null could not 
+    reach its maximum likelihood, while the alternative explains the remaining 
+    variance with the RBF term, which makes flat genes look significant. 
+    
+    The genes are read from adata.X chunk_size genes at a time, so only a 
+    (n_cells, chunk_size) block is ever dense. Genes whose variance along the 
+    selected cells is below min_variance are not fitted, they get a statistic of 
+    0 and a p-value of 1.
+    
+    Keyword arguments:
+    adata -- anndata object
+    genes -- genes to test, from adata.var_names. If None, all genes are tested
+    key, groups -- selection of cells, see timeseries_smooth
+    n_restarts_optimizer, normalize_y, n_inducing, n_jobs, cache_dir -- see fit_gp
+    noise_level, noise_level_bounds, length_scale, length_scale_bounds -- initial 
+        hyperparameters of the kernel and their bounds
+    min_variance -- genes with a smaller variance are rejected without fitting
+    chunk_size -- number of genes fitted at a time
+    key_added -- the statistics are added to adata.var as key_added + '_lr', 
+        '_pval', '_qval', '_length_scale' and '_noise_level', and the table of the 
+        tested genes ranked by the statistic is stored in adata.uns[key_added]
+    
+    Returns the ranked table as a pandas DataFrame.
+    """
+    
+    import numpy as np
+    import pandas as pd
+    from scipy.sparse import issparse
+    from scipy.stats import chi2
+    
+    cells, time = _pseudotime_cells(adata, key, groups)
+    X = np.atleast_2d(time).T
+    var_idx = (np.arange(adata.n_vars) if genes is None 
+               else adata.var_names.get_indexer(list(genes)))
+    if np.any(var_idx < 0):
+        raise ValueError('Genes not found in adata.var_names: {}'
+                         .format(list(np.asarray(genes)[var_idx < 0])))
+    
+    # the selected cells in pseudotime order, as CSC so that gene chunks are cheap
+    data = adata.X[cells]
+    data = data.tocsc() if issparse(data) else np.asarray(data)
+    
+    # cheap pre-screening of flat genes, without densifying
+    if issparse(data):
+        mean = np.asarray(data.mean(axis=0)).ravel()
+        variance = np.asarray(data.multiply(data).mean(axis=0)).ravel() - mean**2
+    else:
+        variance = data.var(axis=0)
+    keep = variance[var_idx] >= min_variance
+    tested = var_idx[keep]
+    # the null noise level of every tested gene has to be reachable by the alternative
+    null_noise = np.ones(len(tested)) if normalize_y else variance[tested]
+    outside = (null_noise < noise_level_bounds[0]) | (null_noise > noise_level_bounds[1])
+    if np.any(outside):
+        raise ValueError('The null noise level of {} genes lies outside of noise_level_bounds, '
+                         'use normalize_y=True or wider bounds.'.format(outside.sum()))
+    
+    kernel = _gp_kernel(length_scale, length_scale_bounds, noise_level, noise_level_bounds)
+    n = len(X)
+    lr = np.zeros(len(tested))
+    params = np.empty((len(tested), len(kernel.theta)))
+    for start in range(0, len(tested), chunk_size):
+        chunk = tested[start:start + chunk_size]
+        Y = data[:, chunk]
+        Y = Y.toarray() if issparse(Y) else np.array(Y)
+        Y = Y.astype(float) - Y.mean(axis=0)
+        if normalize_y:
+            # standardise here, so the null below sees the same targets as the fit
+            std = Y.std(axis=0)
+            Y = Y / np.where(std == 0, 1, std)
+        
+        gps, columns = fit_gp(X, Y, kernel, n_restarts_optimizer=n_restarts_optimizer, 
+                              normalize_y=normalize_y, n_inducing=n_inducing, n_jobs=n_jobs, 
+                              cache_dir=cache_dir, gene_names=adata.var_names[chunk], 
+                              cache_key='{} {}'.format(key, groups))
+        lml = np.array([gene_log_marginal_likelihood(gp)[column] 
+                        for gp, column in zip(gps, columns)])
+        
+        # the null model in closed form: white noise at its maximum likelihood level
+        noise = (Y**2).mean(axis=0)
+        lml_null = -0.5 * (Y**2).sum(axis=0) / noise - 0.5 * n * np.log(2 * np.pi * noise)
+        
+        lr[start:start + len(chunk)] = np.maximum(2 * (lml - lml_null), 0)
+        params[start:start + len(chunk)] = np.exp([gp.kernel_.theta for gp in gps])
+    
+    pval = chi2.sf(lr, 1)
+    # Benjamini-Hochberg over all tested genes, the rejected ones count as p = 1
+    n_tests = len(var_idx)
+    order = np.argsort(pval)
+    qval = np.empty(len(pval))
+    qval[order] = np.minimum.accumulate((pval[order] * n_tests 
+                                         / np.arange(1, len(pval) + 1))[::-1])[::-1]
+    qval = np.minimum(qval, 1)
+    
+    names = [h.name for h in kernel.hyperparameters]
+    table = pd.DataFrame({'lr': np.zeros(len(var_idx)), 'pval': np.ones(len(var_idx)), 
+                          'qval': np.ones(len(var_idx)), 
+                          'length_scale': np.nan, 'noise_level': np.nan}, 
+                         index=adata.var_names[var_idx])
+    rows = np.flatnonzero(keep)
+    table.iloc[rows, :3] = np.column_stack([lr, pval, qval])
+    table.iloc[rows, 3] = params[:, names.index('k1__k2__length_scale')]
+    table.iloc[rows, 4] = params[:, names.index('k2__noise_level')]
+    table = table.sort_values('lr', ascending=False)
+    
+    if key_added is not None:
+        for column in table.columns:
+            adata.var[key_added + '_' + column] = table[column].reindex(adata.var_names)
+        adata.uns[key_added] = table
+    return table
+
+
+def _pseudotime_cells(adata, key = 'louvain', groups = 'all'):
+    
+    # indices of the cells of the selected groups sorted by pseudotime, without 
+    # the last one, and their pseudotime
+    import numpy as np
+    
+    # select one branch
+    if not isinstance(groups, str) or groups != 'all':
+        cells = np.flatnonzero(np.isin(adata.obs[key], groups))
+    else:
+        cells = np.arange(adata.n_obs)
+    
+    # extract the pseudotime and sort according to it
+    time = adata.obs['dpt_pseudotime'].values[cells]
+    order = np.argsort(time)
+    
+    # remove the last entry
+    order = order[:-1]
+    return cells[order], time[order]
+
+
+def _pseudotime_data(adata, genes = 'none', gene_symbols = 'none', key = 'louvain', groups = 'all', 
+                     densify = True):
+    
+    # cells of the selected groups sorted by pseudotime, without the last one, and 
+    # the expression of the selected genes. Returns the pseudotime as a column 
+    # vector, the expression matrix (cells x genes), dense unless densify is False, 
+    # and the gene names
+    import pandas as pd
+    import numpy as np
+    from scipy.sparse import issparse
+    
+    cells, time = _pseudotime_cells(adata, key, groups)
+        
+    # select genes
+    if isinstance(genes, str) and genes == 'none':
+        
+        # no genes specified, we just use the first 5
+        genes = adata.var_names.values[0:5]
+        mapped = genes
+        
+    elif gene_symbols != 'none':
+        
+        # a gene annotation is used, we map the gene names
+        mapping_table = pd.DataFrame(adata.var[gene_symbols])
+        name_mapping = mapping_table.set_index(gene_symbols)
+        name_mapping['Ensembl'] = mapping_table.index
+        mapped = name_mapping.loc[genes, 'Ensembl'].values
+    else:
+        mapped = genes
+    
+    data = adata[:, list(mapped)].X[cells]
+    if not issparse(data):
+        data = np.asarray(data)
+    elif densify:
+        data = data.toarray()
+    return (np.atleast_2d(time).T, data.astype(float), 
+            np.array([str(g) for g in genes]))
+
+
+def bin_pseudotime(X, Y, n_bins = 100):
+    
+    """
+    Aggregate cells into adaptive pseudotime bins
+    
+    The bin edges are quantiles of the pseudotime, so every bin holds about the 
+    same number of cells and densely sampled stretches get narrow bins. Cells with 
+    the same pseudotime always fall into the same bin, so there can be fewer bins.
+    
+    Keyword arguments:
+    X -- pseudotime, shape (n_cells, 1)
+    Y -- expression, shape (n_cells, n_genes)
+    n_bins -- maximal number of bins
+    
+    Returns the mean pseudotime of every bin as a column vector, the mean and the 
+    variance of the expression within every bin, shape (n_bins, n_genes), and the 
+    number of cells in every bin. These are the inputs of fit_gp for binned data.
+    """
+    
+    import numpy as np
+    
+    t = np.asarray(X, dtype=float).ravel()
+    Y = np.asarray(Y, dtype=float).reshape(len(t), -1)
+    order = np.argsort(t, kind='stable')
+    t, Y = t[order], Y[order]
+    
+    # the first cell of every bin
+    starts = np.unique(np.searchsorted(t, np.quantile(t, np.linspace(0, 1, n_bins + 1)[:-1])))
+    counts = np.diff(np.append(starts, len(t))).astype(float)
+    means = np.add.reduceat(Y, starts, axis=0) / counts[:, None]
+    variances = np.add.reduceat(Y**2, starts, axis=0) / counts[:, None] - means**2
+    return (np.add.reduceat(t, starts)[:, None] / counts[:, None], means, 
+            np.maximum(variances, 0), counts)
+
+
+def _gp_kernel(length_scale = 1, length_scale_bounds = (1e-2, 1e+1), 
+               noise_level = 0.5, noise_level_bounds = (1e-2, 1e+1)):
+    
+    # the kernel of timeseries_smooth: a smooth signal plus white noise, whose level 
+    # is estimated via optimisation of the marginal likelihood as well
+    from sklearn.gaussian_process.kernels import RBF, WhiteKernel
+    
+    return 1.0 * RBF(length_scale=length_scale, length_scale_bounds=length_scale_bounds) \
+        + WhiteKernel(noise_level=noise_level, noise_level_bounds=noise_level_bounds)
+
+
+def fit_gp(X, Y, kernel, kernel_groups = None, n_restarts_optimizer = 10, normalize_y = False, 
+           random_state = 0, n_inducing = None, n_jobs = 1, parallel_restarts = False, 
+           counts = None, variances = None, cache_dir = None, gene_names = None, cache_key = ''):
+    
+    """
+    Fit Gaussian processes to many genes which share the inputs X
+    
+    The kernel hyperparameters of a group of genes are fitted by maximising the 
+    sum of their log-marginal-likelihoods, see shared_log_marginal_likelihood: 
+    every hyperparameter setting tried by the optimiser costs one kernel matrix 
+    and one Cholesky factorisation for the whole group instead of one per gene. 
+    The group is then stored as one multi-output GaussianProcessRegressor.
+    
+    Keyword arguments:
+    X -- inputs, shape (n_cells, 1), e.g. the pseudotime
+    Y -- targets, shape (n_cells, n_genes)
+    kernel -- sklearn kernel holding the initial hyperparameters and their bounds
+    kernel_groups -- None to fit every gene separately, 'all' to share the 
+        hyperparameters between all genes or one label per gene
+    n_restarts_optimizer -- number of additional optimiser runs per group, started 
+        from hyperparameters drawn log-uniformly within the bounds
+    normalize_y -- standardise every gene before fitting, as in GaussianProcessRegressor
+    random_state -- seed for the restarts
+    n_inducing -- if given and smaller than the number of cells, fit a SparseGP 
+        with this many inducing points instead
+    n_jobs -- number of processes. Values above 1 distribute the groups of genes 
+        across a process pool. All starting points are drawn before, so the result 
+        does not depend on n_jobs
+    parallel_restarts -- with n_jobs above 1, also distribute the optimiser runs of 
+        every group, which helps when there are fewer groups than processes
+    counts, variances -- if given, the rows of X and Y are bins of counts cells with 
+        mean expression Y and within-bin variances, see bin_pseudotime. The white 
+        noise of a bin is then the noise level divided by its count, and the 
+        likelihood includes the spread within the bins, so it approximates the 
+        likelihood of the cells. Not supported with n_inducing
+    cache_dir -- if given, the optimised hyperparameters of every group are saved to 
+        this directory and reused when the same genes are fitted again to the same 
+        data with the same settings, so repeated calls skip the optimisation. A 
+        group which is not in the cache starts from the last hyperparameters cached 
+        for its genes with the same kernel, e.g. from another lineage, instead of the 
+        initial kernel. Failing that, it starts from the cached optimum of the group 
+        of this call whose binned mean expression profile is most (anti-)correlated 
+        with its own, if any group of this call is in the cache
+    gene_names -- names of the genes for the cache, by default their columns
+    cache_key -- additional description of the data for the cache, e.g. the 
+        selection of cells
+    
+    Returns a list with the fitted GaussianProcessRegressor (or SparseGP) of every 
+    gene, genes of one group share the same object, and an array with the column 
+    of every gene in the targets of its regressor.
+    """
+    
+    import numpy as np
+    from sklearn.gaussian_process import GaussianProcessRegressor
+    
+    X = np.asarray(X, dtype=float).reshape(len(X), -1)
+    Y = np.asarray(Y, dtype=float).reshape(len(X), -1)
+    n_genes = Y.shape[1]
+    if kernel_groups is None:
+        labels = np.arange(n_genes)
+    elif isinstance(kernel_groups, str) and kernel_groups == 'all':
+        labels = np.zeros(n_genes, dtype=int)
+    else:
+        labels = np.asarray(kernel_groups)
+        if len(labels) != n_genes:
+            raise ValueError('kernel_groups needs one label per gene, got {} for {} genes.'
+                             .format(len(labels), n_genes))
+    
+    sparse = n_inducing is not None and n_inducing < len(X)
+    Z = inducing_points(X, n_inducing) if sparse else None
+    if counts is not None:
+        if sparse:
+            raise ValueError('Binned data cannot be fitted with inducing points.')
+        counts = np.asarray(counts, dtype=float)
+        variances = (np.zeros_like(Y) if variances is None 
+                     else np.asarray(variances, dtype=float).reshape(Y.shape))
+    
+    # start from the initial kernel, then from random points within the bounds. 
+    # Draw them all here, so every group gets the same starts however it is run
+    rng = np.random.RandomState(random_state)
+    bounds = kernel.bounds
+    groups = [np.flatnonzero(labels == label) for label in np.unique(labels)]
+    starts = [[kernel.theta] + [rng.uniform(bounds[:, 0], bounds[:, 1]) 
+                                for _ in range(n_restarts_optimizer)] for _ in groups]
+    
+    # look up the groups in the cache before the warm starts change their starts
+    results = [None] * len(groups)
+    if cache_dir is not None:
+        names = (np.arange(n_genes) if gene_names is None else np.asarray(gene_names)).astype(str)
+        paths = [_cache_path(cache_dir, names[genes], cache_key, kernel, X, Y[:, genes], 
+                             thetas, bounds, normalize_y, n_inducing, counts, 
+                             None if counts is None else variances[:, genes]) 
+                 for genes, thetas in zip(groups, starts)]
+        cold = []
+        index = None
+        for i, genes in enumerate(groups):
+            results[i] = _load_fit(paths[i])
+            if results[i] is None and index is None:
+                index = _cache_index(cache_dir)
+            warm = _warm_start(index, names[genes], kernel) if results[i] is None else None
+            if warm is not None:
+                starts[i][0] = np.clip(warm, bounds[:, 0], bounds[:, 1])
+            elif results[i] is None:
+                cold.append(i)
+        # neighbouring genes: seed the rest from the most similar cached group
+        cached = [i for i in range(len(groups)) if results[i] is not None]
+        if cold and cached:
+            nearest = _nearest_groups(X, Y, groups, cold, cached)
+            for i, j in zip(cold, nearest):
+                starts[i][0] = np.clip(results[j].x, bounds[:, 0], bounds[:, 1])
+    todo = [i for i in range(len(groups)) if results[i] is None]
+    
+    if n_jobs > 1 and todo:
+        from multiprocessing import Pool
+        
+        if parallel_restarts:
+            tasks = [(groups[i], [theta]) for i in todo for theta in starts[i]]
+        else:
+            tasks = [(groups[i], starts[i]) for i in todo]
+        with Pool(n_jobs, initializer=_init_gp_worker, 
+                  initargs=(kernel, X, Y, Z, normalize_y, counts, variances)) as pool:
+            fitted = pool.map(_gp_worker, tasks)
+        if parallel_restarts:
+            # pool.map keeps the order of the tasks, so ties go to the same start as below
+            n_starts = n_restarts_optimizer + 1
+            fitted = [min(fitted[i:i + n_starts], key=lambda res: res.fun) 
+                      for i in range(0, len(fitted), n_starts)]
+    else:
+        fitted = [_optimise_group(kernel, X, Y[:, groups[i]], Z, normalize_y, starts[i], counts, 
+                                  None if counts is None else variances[:, groups[i]]) 
+                  for i in todo]
+    for i, best in zip(todo, fitted):
+        results[i] = best
+        if cache_dir is not None:
+            _save_fit(paths[i], best, names[groups[i]], kernel)
+    
+    gps, columns = [None] * n_genes, np.zeros(n_genes, dtype=int)
+    for genes, best in zip(groups, results):
+        # store the group as a regressor with the optimised kernel, which is not refitted
+        kernel_ = kernel.clone_with_theta(best.x)
+        if sparse:
+            gp = SparseGP(kernel_, Z, normalize_y=normalize_y)
+        elif counts is not None:
+            # the WhiteKernel adds the noise level to every bin, the per-sample alpha 
+            # corrects it to noise level / count
+            noise = kernel_.k2.noise_level
+            gp = GaussianProcessRegressor(kernel=kernel_, alpha=noise * (1 / counts - 1), 
+                                          optimizer=None, normalize_y=normalize_y)
+        else:
+            gp = GaussianProcessRegressor(kernel=kernel_, alpha=0.0, 
+                                          optimizer=None, normalize_y=normalize_y)
+        gp.fit(X, Y[:, genes] if len(genes) > 1 else Y[:, genes[0]])
+        if counts is not None:
+            v = variances[:, genes]
+            if normalize_y:
+                std = Y[:, genes].std(axis=0)
+                v = v / np.where(std == 0, 1, std)**2
+            gp.gene_log_marginal_likelihood_ = (gene_log_marginal_likelihood(gp) 
+                                                + _within_bins_log_likelihood(noise, counts, v))
+        gp.log_marginal_likelihood_value_ = -best.fun
+        for column, gene in enumerate(genes):
+            gps[gene], columns[gene] = gp, column
+    return gps, columns
+
+
+def _genes_hash(names):
+    
+    # prefix of the cache files of a group of genes
+    import hashlib
+    
+    return hashlib.sha1('\n'.join(names).encode()).hexdigest()[:16]
+
+def _cache_path(cache_dir, names, cache_key, kernel, X, y, starts, bounds, normalize_y, 
+                n_inducing, counts, variances):
+    
+    # the cache file of a group of genes: the hash of its names, for the warm starts, 
+    # and the hash of everything that determines the optimum
+    import os
+    import hashlib
+    import numpy as np
+    
+    fit = hashlib.sha1(str(cache_key).encode())
+    fit.update(repr((repr(kernel), normalize_y, n_inducing, y.shape)).encode())
+    for array in [X, y, np.array(starts), bounds, counts, variances]:
+        if array is not None:
+            fit.update(np.ascontiguousarray(array, dtype=float).tobytes())
+    return os.path.join(cache_dir, '{}_{}.npz'.format(_genes_hash(names), fit.hexdigest()[:24]))
+
+def _load_fit(path):
+    
+    # the cached optimum, like the result of scipy.optimize.minimize, or None
+    import os
+    import numpy as np
+    from scipy.optimize import OptimizeResult
+    
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as cached:
+        return OptimizeResult(x=cached['theta'], fun=-float(cached['lml']))
+
+def _save_fit(path, best, names, kernel):
+    
+    import os
+    import numpy as np
+    
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    np.savez(path, theta=best.x, lml=-best.fun, genes=np.asarray(names), 
+             kernel=_kernel_structure(kernel))
+
+def _kernel_structure(kernel):
+    
+    # the kernel with all hyperparameters set to 1, so kernels with the same terms match
+    import numpy as np
+    
+    return repr(kernel.clone_with_theta(np.zeros_like(kernel.theta)))
+
+def _cache_index(cache_dir):
+    
+    # the cache files by the hash prefix of their genes, newest first, from a single 
+    # scan of the directory
+    import os
+    
+    index = {}
+    if not os.path.isdir(cache_dir):
+        return index
+    for entry in os.scandir(cache_dir):
+        prefix, _, suffix = entry.name.partition('_')
+        if suffix.endswith('.npz') and entry.is_file():
+            index.setdefault(prefix, []).append((entry.stat().st_mtime, entry.path))
+    return {prefix: [path for _, path in sorted(files, reverse=True)] 
+            for prefix, files in index.items()}
+
+def _warm_start(index, names, kernel):
+    
+    # the last hyperparameters cached for these genes with the same kernel terms and 
+    # any data, or None. index is the result of _cache_index
+    import numpy as np
+    
+    structure = _kernel_structure(kernel)
+    for path in index.get(_genes_hash(names), []):
+        with np.load(path) as cached:
+            if 'kernel' in cached and str(cached['kernel']) == structure:
+                return cached['theta']
+    return None
+
+def _nearest_groups(X, Y, groups, cold, cached):
+    
+    # for every group in cold, the group in cached whose mean expression, averaged in 
+    # pseudotime bins to suppress the noise, is most correlated or anti-correlated
+    import numpy as np
+    
+    means = np.column_stack([Y[:, genes].mean(axis=1) for genes in groups])
+    profiles = bin_pseudotime(X[:, :1], means, 50)[1]
+    profiles = profiles - profiles.mean(axis=0)
+    norms = np.linalg.norm(profiles, axis=0)
+    profiles = profiles / np.where(norms == 0, 1, norms)
+    similarity = np.abs(np.dot(profiles[:, cold].T, profiles[:, cached]))
+    return [cached[j] for j in similarity.argmax(axis=1)]
+
+
+def _optimise_group(kernel, X, y, Z, normalize_y, starts, counts = None, variances = None):
+    
+    # maximise the summed log-marginal-likelihood of the genes y from every start, 
+    # return the best scipy result. Z are the inducing inputs, None for the exact GP, 
+    # counts and variances describe binned data, see fit_gp
+    import numpy as np
+    from scipy.optimize import minimize
+    
+    if normalize_y:
+        std = np.where(y.std(axis=0) == 0, 1, y.std(axis=0))
+        y = (y - y.mean(axis=0)) / std
+        if variances is not None:
+            variances = variances / std**2
+    
+    if Z is not None:
+        # the approximate bound has no analytic gradient here, use finite differences
+        def obj_func(theta):
+            return -sparse_log_marginal_likelihood(kernel, theta, X, y, Z)
+    else:
+        def obj_func(theta):
+            lml, grad = shared_log_marginal_likelihood(kernel, theta, X, y, eval_gradient=True, 
+                                                       counts=counts, variances=variances)
+            return -lml, -grad
+    
+    results = [minimize(obj_func, theta, method='L-BFGS-B', jac=Z is None, bounds=kernel.bounds) 
+               for theta in starts]
+    return min(results, key=lambda res: res.fun)
+
+
+# data of fit_gp seen by the worker processes, set once per worker by _init_gp_worker 
+# so only gene indices and starting points are pickled per task
+_gp_data = {}
+
+def _init_gp_worker(kernel, X, Y, Z, normalize_y, counts, variances):
+    global _gp_data
+    _gp_data = {'kernel': kernel, 'X': X, 'Y': Y, 'Z': Z, 'normalize_y': normalize_y, 
+                'counts': counts, 'variances': variances}
+
+def _gp_worker(task):
+    genes, starts = task
+    variances = _gp_data['variances']
+    return _optimise_group(_gp_data['kernel'], _gp_data['X'], _gp_data['Y'][:, genes], 
+                           _gp_data['Z'], _gp_data['normalize_y'], starts, _gp_data['counts'], 
+                           None if variances is None else variances[:, genes])
+
+
+def shared_log_marginal_likelihood(kernel, theta, X, Y, eval_gradient = False, 
+                                   counts = None, variances = None):
+    
+    """
+    Sum of the log-marginal-likelihoods of all columns of Y under one kernel
+    
+    The kernel matrix and its Cholesky factor are computed once for all columns. 
+    The gradient with respect to the log-hyperparameters theta only needs the 
+    (n_cells, n_cells) matrix alpha alpha' summed over the columns, so memory does 
+    not grow with the number of genes.
+    
+    Keyword arguments:
+    kernel -- sklearn kernel
+    theta -- log-transformed hyperparameters of the kernel
+    X -- inputs, shape (n_cells, 1)
+    Y -- targets, shape (n_cells, n_genes)
+    eval_gradient -- also return the gradient with respect to theta
+    counts, variances -- binned data, see fit_gp. The kernel must then be a sum of 
+        a signal kernel and a WhiteKernel
+    """
+    
+    import numpy as np
+    from scipy.linalg import cholesky, cho_solve
+    
+    Y = Y.reshape(len(X), -1)
+    n, k = Y.shape
+    kernel = kernel.clone_with_theta(theta)
+    if eval_gradient:
+        K, K_gradient = kernel(X, eval_gradient=True)
+    else:
+        K = kernel(X)
+    if counts is not None:
+        # the noise of the mean of a bin is the noise level / count. The noise level 
+        # is the last hyperparameter, its gradient is the noise on the diagonal
+        noise = kernel.k2.noise_level
+        K[np.diag_indices(n)] += noise * (1 / counts - 1)
+        if eval_gradient:
+            K_gradient[np.arange(n), np.arange(n), -1] = noise / counts
+    try:
+        L = cholesky(K, lower=True, check_finite=False)
+    except np.linalg.LinAlgError:
+        return (-np.inf, np.zeros_like(theta)) if eval_gradient else -np.inf
+    
+    alpha = cho_solve((L, True), Y, check_finite=False)
+    lml = (-0.5 * np.einsum('ij,ij', Y, alpha) - k * np.log(np.diag(L)).sum()
+           - 0.5 * k * n * np.log(2 * np.pi))
+    if counts is not None:
+        lml += _within_bins_log_likelihood(noise, counts, variances).sum()
+    if not eval_gradient:
+        return lml
+    
+    inner = np.dot(alpha, alpha.T) - k * cho_solve((L, True), np.eye(n), check_finite=False)
+    grad = 0.5 * np.einsum('ij,jil->l', inner, K_gradient)
+    if counts is not None:
+        grad[-1] += (0.5 * np.dot(counts, variances).sum() / noise 
+                     - 0.5 * k * (counts.sum() - n))
+    return lml, grad
+
+
+def _within_bins_log_likelihood(noise, counts, variances):
+    
+    # log-likelihood of the spread of the cells around their bin means, per gene. 
+    # With the signal constant within a bin, this plus the likelihood of the bin 
+    # means under noise / count is the likelihood of the cells
+    import numpy as np
+    
+    return (-0.5 * np.dot(counts, variances) / noise 
+            - 0.5 * (counts.sum() - len(counts)) * np.log(2 * np.pi * noise) 
+            - 0.5 * np.log(counts).sum())
+
+
+def log_marginal_likelihood_grid(X, Y, length_scales, noise_levels, constant = 1.0, 
+                                 normalize_y = False, Z = None, counts = None, 
+                                 variances = None):
+    
+    """
+    Log-marginal-likelihood of the kernel constant * RBF + WhiteKernel on a grid 
+    of length scales and noise levels, summed over the columns of Y
+    
+    The squared distances between the inputs are computed once. For every length 
+    scale the signal kernel matrix is eigendecomposed once, K = U diag(lam) U', 
+    after which the likelihood for all noise levels s follows from 
+    sum((U'y)**2 / (lam + s)) and sum(log(lam + s)) without further factorisations. 
+    With inducing inputs Z the variational bound of sparse_log_marginal_likelihood 
+    is evaluated the same way, from the eigenvalues of an (m, m) matrix. For binned 
+    data the noise of a bin is s / count, so C^1/2 K C^1/2 with C = diag(counts) is 
+    decomposed instead, and the spread within the bins is added, as in fit_gp.
+    
+    Keyword arguments:
+    X -- inputs, shape (n_cells, 1)
+    Y -- targets, shape (n_cells,) or (n_cells, n_genes)
+    length_scales, noise_levels -- the grid
+    constant -- the fixed signal variance
+    normalize_y -- standardise the targets first, as in GaussianProcessRegressor
+    Z -- inducing inputs, see inducing_points. If None, the exact likelihood is used
+    counts, variances -- binned data, see fit_gp. Cannot be combined with Z
+    
+    Returns an array of shape (len(noise_levels), len(length_scales)), like the 
+    meshgrid of the length scales and noise levels.
+    """
+    
+    import numpy as np
+    from scipy.linalg import cholesky, solve_triangular
+    from scipy.spatial.distance import cdist
+    
+    X = np.asarray(X, dtype=float).reshape(len(X), -1)
+    Y = np.asarray(Y, dtype=float).reshape(len(X), -1)
+    if counts is not None:
+        if Z is not None:
+            raise ValueError('Binned data cannot be evaluated with inducing points.')
+        counts = np.asarray(counts, dtype=float)
+        variances = (np.zeros_like(Y) if variances is None 
+                     else np.asarray(variances, dtype=float).reshape(Y.shape))
+    if normalize_y:
+        std = np.where(Y.std(axis=0) == 0, 1, Y.std(axis=0))
+        Y = (Y - Y.mean(axis=0)) / std
+        if counts is not None:
+            variances = variances / std**2
+    n, k = Y.shape
+    noise = np.asarray(noise_levels, dtype=float)[:, None]
+    if counts is not None:
+        # the log(counts) of the bin noise and of the spread within the bins cancel
+        sqrt_counts = np.sqrt(counts)[:, None]
+        Y = sqrt_counts * Y
+        within = (-0.5 * np.dot(counts, variances).sum() / noise[:, 0] 
+                  - 0.5 * k * (counts.sum() - n) * np.log(2 * np.pi * noise[:, 0]))
+    
+    if Z is None:
+        D = cdist(X, X, 'sqeuclidean')
+    else:
+        D, D_mn = cdist(Z, Z, 'sqeuclidean'), cdist(Z, X, 'sqeuclidean')
+        yy = (Y**2).sum()
+    
+    LML = np.empty((len(noise), len(length_scales)))
+    for j, length_scale in enumerate(length_scales):
+        K = constant * np.exp(-0.5 * D / length_scale**2)
+        if counts is not None:
+            K = sqrt_counts * K * sqrt_counts.T
+        if Z is None:
+            lam, U = np.linalg.eigh(K)
+            r2 = (np.dot(U.T, Y)**2).sum(axis=1)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                lml = (-0.5 * (r2 / (lam + noise)).sum(axis=1) 
+                       - 0.5 * k * np.log(lam + noise).sum(axis=1))
+            LML[:, j] = np.where(np.isnan(lml), -np.inf, lml) - 0.5 * k * n * np.log(2 * np.pi)
+            if counts is not None:
+                LML[:, j] += within
+        else:
+            # A0 = Lm^-1 Kmn, the noise-free part of A in _sparse_terms
+            K[np.diag_indices_from(K)] += 1e-6 * constant
+            try:
+                Lm = cholesky(K, lower=True, check_finite=False)
+            except np.linalg.LinAlgError:
+                LML[:, j] = -np.inf
+                continue
+            A0 = solve_triangular(Lm, constant * np.exp(-0.5 * D_mn / length_scale**2), 
+                                  lower=True, check_finite=False)
+            lam, V = np.linalg.eigh(np.dot(A0, A0.T))
+            lam = np.maximum(lam, 0)
+            r2 = (np.dot(V.T, np.dot(A0, Y))**2).sum(axis=1)
+            LML[:, j] = (-0.5 * n * k * np.log(2 * np.pi * noise[:, 0]) 
+                         - 0.5 * k * np.log(1 + lam / noise).sum(axis=1)
+                         - 0.5 * yy / noise[:, 0] 
+                         + 0.5 * (r2 / ((lam + noise) * noise)).sum(axis=1)
+                         - 0.5 * k * (n * constant - lam.sum()) / noise[:, 0])
+    return LML
+
+
+def gene_log_marginal_likelihood(gp):
+    
+    """
+    Log-marginal-likelihood of every target of a fitted GaussianProcessRegressor 
+    at its optimised kernel. For a multi-output fit these sum to 
+    gp.log_marginal_likelihood_value_. For a SparseGP these are the per-gene 
+    approximate bounds, for binned data they include the spread within the bins.
+    """
+    
+    import numpy as np
+    
+    if hasattr(gp, 'gene_log_marginal_likelihood_'):
+        return gp.gene_log_marginal_likelihood_
+    y = gp.y_train_.reshape(len(gp.y_train_), -1)
+    alpha = gp.alpha_.reshape(y.shape)
+    return (-0.5 * np.einsum('ij,ij->j', y, alpha) - np.log(np.diag(gp.L_)).sum()
+            - 0.5 * len(y) * np.log(2 * np.pi))
+
+
+def _unique_gps(gps):
+    
+    # the distinct regressors in gps and the genes they were fitted to
+    groups = {}
+    for gene, gp in enumerate(gps):
+        groups.setdefault(id(gp), (gp, []))[1].append(gene)
+    return list(groups.values())
+
+
+def inducing_points(X, n_inducing):
+    
+    """
+    Inducing inputs for SparseGP: n_inducing quantiles of the 1D inputs X, so 
+    densely sampled stretches of pseudotime get more inducing points.
+    """
+    
+    import numpy as np
+    
+    return np.unique(np.quantile(np.asarray(X, dtype=float).ravel(), 
+                                 np.linspace(0, 1, n_inducing)))[:, None]
+
+
+def _sparse_terms(kernel, X, Z, Y):
+    
+    # Cholesky factors and projections shared by the bound and the predictions.
+    # kernel is signal + WhiteKernel, the white noise is the likelihood variance
+    import numpy as np
+    from scipy.linalg import cholesky, solve_triangular
+    
+    signal, noise = kernel.k1, kernel.k2.noise_level
+    Kmm = signal(Z)
+    Kmm[np.diag_indices_from(Kmm)] += 1e-6 * np.mean(np.diag(Kmm))
+    Lm = cholesky(Kmm, lower=True, check_finite=False)
+    # A = Lm^-1 Kmn / sigma, the only O(n m^2) step
+    A = solve_triangular(Lm, signal(Z, X), lower=True, check_finite=False) / np.sqrt(noise)
+    B = np.dot(A, A.T)
+    B[np.diag_indices_from(B)] += 1
+    LB = cholesky(B, lower=True, check_finite=False)
+    c = solve_triangular(LB, np.dot(A, Y), lower=True, check_finite=False) / np.sqrt(noise)
+    return signal, noise, Lm, A, LB, c
+
+
+def sparse_log_marginal_likelihood(kernel, theta, X, Y, Z, per_gene = False):
+    
+    """
+    Variational lower bound (Titsias, 2009) on the log-marginal-likelihood of 
+    every column of Y, summed over the columns unless per_gene
+    
+    With m inducing inputs Z the kernel matrix is approximated by the Nystroem 
+    approximation Knm Kmm^-1 Kmn, so the cost is O(n * m**2) instead of O(n**3). 
+    The kernel must be a sum of a signal kernel and a WhiteKernel, e.g. 
+    C * RBF + WhiteKernel, the noise level of the latter is the noise variance.
+    
+    Keyword arguments:
+    kernel -- sklearn kernel, signal + WhiteKernel
+    theta -- log-transformed hyperparameters of the kernel
+    X -- inputs, shape (n_cells, 1)
+    Y -- targets, shape (n_cells, n_genes)
+    Z -- inducing inputs, shape (n_inducing, 1), see inducing_points
+    per_gene -- return the bound of every column instead of their sum
+    """
+    
+    import numpy as np
+    
+    Y = Y.reshape(len(X), -1)
+    n = len(X)
+    try:
+        signal, noise, Lm, A, LB, c = _sparse_terms(kernel.clone_with_theta(theta), X, Z, Y)
+    except np.linalg.LinAlgError:
+        return np.full(Y.shape[1], -np.inf) if per_gene else -np.inf
+    
+    lml = (-0.5 * n * np.log(2 * np.pi * noise) - np.log(np.diag(LB)).sum()
+           - 0.5 * (Y**2).sum(axis=0) / noise + 0.5 * (c**2).sum(axis=0)
+           # the trace term penalises the variance the inducing points do not explain
+           - 0.5 * (signal.diag(X).sum() / noise - (A**2).sum()))
+    return lml if per_gene else lml.sum()
+
+
+class SparseGP(object):
+    
+    """
+    Inducing-point Gaussian process regression for many genes which share the inputs
+    
+    Counterpart of a GaussianProcessRegressor fitted with optimizer=None: the 
+    kernel is kept fixed, predict returns the posterior mean and the standard 
+    deviation or covariance of new observations, including the white noise, at 
+    the cost of O(n_cells * n_inducing**2) for fitting. Used by fit_gp, which 
+    optimises the kernel with sparse_log_marginal_likelihood.
+    
+    Keyword arguments:
+    kernel -- sklearn kernel, signal + WhiteKernel
+    Z -- inducing inputs, shape (n_inducing, 1)
+    normalize_y -- standardise every gene before fitting
+    """
+    
+    def __init__(self, kernel, Z, normalize_y = False):
+        self.kernel_ = kernel
+        self.Z = Z
+        self.normalize_y = normalize_y
+    
+    def fit(self, X, y):
+        
+        import numpy as np
+        
+        y = np.asarray(y, dtype=float)
+        self._y_shape = y.shape[1:]
+        Y = y.reshape(len(X), -1)
+        self._y_mean, self._y_std = np.zeros(Y.shape[1]), np.ones(Y.shape[1])
+        if self.normalize_y:
+            self._y_mean, self._y_std = Y.mean(axis=0), Y.std(axis=0)
+            self._y_std[self._y_std == 0] = 1
+            Y = (Y - self._y_mean) / self._y_std
+        self.X_train_, self.y_train_ = X, Y
+        signal, noise, self._Lm, A, self._LB, self._c = _sparse_terms(self.kernel_, X, 
+                                                                      self.Z, Y)
+        self.gene_log_marginal_likelihood_ = sparse_log_marginal_likelihood(
+            self.kernel_, self.kernel_.theta, X, Y, self.Z, per_gene=True)
+        self.log_marginal_likelihood_value_ = self.gene_log_marginal_likelihood_.sum()
+        return self
+    
+    def log_marginal_likelihood(self, theta = None):
+        
+        if theta is None:
+            return self.log_marginal_likelihood_value_
+        return sparse_log_marginal_likelihood(self.kernel_, theta, self.X_train_, 
+                                              self.y_train_, self.Z)
+    
+    def predict(self, X, return_std = False, return_cov = False):
+        
+        import numpy as np
+        from scipy.linalg import solve_triangular
+        
+        signal, noise = self.kernel_.k1, self.kernel_.k2.noise_level
+        # posterior of the inducing values, projected to X
+        V = solve_triangular(self._Lm, signal(self.Z, X), lower=True, check_finite=False)
+        W = solve_triangular(self._LB, V, lower=True, check_finite=False)
+        y_mean = np.dot(W.T, self._c) * self._y_std + self._y_mean
+        y_mean = y_mean.reshape((len(X),) + self._y_shape)
+        if return_cov:
+            y_cov = signal(X) - np.dot(V.T, V) + np.dot(W.T, W) + noise * np.eye(len(X))
+            y_cov = y_cov[:, :, None] * self._y_std**2
+            return y_mean, y_cov.reshape((len(X), len(X)) + self._y_shape)
+        if return_std:
+            y_var = signal.diag(X) - (V**2).sum(axis=0) + (W**2).sum(axis=0) + noise
+            y_std = np.sqrt(np.outer(np.maximum(y_var, 0), self._y_std**2))
+            return y_mean, y_std.reshape((len(X),) + self._y_shape)
+        return y_mean
@@ -1679,11 +1679,14 @@ def plot_gene(adata, ax, x, y, type='gene', x_test=None, x_mean=None, x_cov=None
     x_test: np.array, optional (default: `None`)
         Grid of values for testing
     x_mean: np.array, optional (default: `None`)
-        Smoothed expression values
+        Smoothed expression values, e.g. the `mean` of `gp_de.kernel_smooth`
+        for `x_test` its `grid`
     x_cov: np.array, optional (default: `None`)
-        Covariance matrix for smoothed expression
+        Pointwise variances of the smoothed expression, or its full covariance
+        matrix, of which only the diagonal is used, e.g. the `var` of
+        `gp_de.kernel_smooth`
     x_grad: np.array, optional (default: `None`)
-        Derivative of gene expression
+        Derivative of gene expression, e.g. the `grad` of `gp_de.kernel_smooth`
     gene_name: str, optional (default: `" "`)
         Name of the gene for plotting
     scatter_kwgs: None or dict, optional (default: `None`)
@@ -1708,8 +1711,9 @@ def plot_gene(adata, ax, x, y, type='gene', x_test=None, x_mean=None, x_cov=None
                     label='Smoothed {} expression values'.format(type))
             # add covariance
             if x_cov is not None:
-                ax.fill_between(x_test.flatten(), x_mean - np.sqrt(np.diag(x_cov)),
-                                x_mean + np.sqrt(np.diag(x_cov)),
+                x_var = np.diag(x_cov) if np.ndim(x_cov) == 2 else np.asarray(x_cov)
+                ax.fill_between(x_test.flatten(), x_mean - np.sqrt(x_var),
+                                x_mean + np.sqrt(x_var),
                                 alpha=0.5, color='k')
         # add the derivative
         if x_grad is not None: